@@ -1,5 +1,7 @@
 import re
+from functools import partial
 from pathlib import Path
+from typing import Callable
 
 import cv2
 import numpy as np
@@ -7,29 +9,32 @@ import torch
 import torch.nn as nn
 from PIL import Image
 from omegaconf import OmegaConf
+from scipy import ndimage
 from transformers import AutoProcessor, AutoModel
 
-USE_SAMHQ = False
-if USE_SAMHQ:
-    from segment_anything import SamAutomaticMaskGenerator, SamPredictor, sam_model_registry
-else:
-    from sam2.build_sam import build_sam2
-    from sam2.sam2_image_predictor import SAM2ImagePredictor
-    from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+from samesh.data.common import NumpyTensor
+from samesh.utils.masks import PackedMasks
 
 
-from samesh.data.common import NumpyTensor
+PREDICTOR_STATE = ('_features', '_orig_hw', '_is_image_set', '_is_batch') # SAM2ImagePredictor state set by Sam2Model.forward_batch
 
 
-def combine_bmasks(masks: NumpyTensor['n h w'], sort=False) -> NumpyTensor['h w']:
+def stack_annotations(annotations: list[dict]) -> PackedMasks:
     """
+    Packs masks of annotations by decreasing area, one mask at a time.
     """
-    mask_combined = np.zeros_like(masks[0], dtype=int)
-    if sort:
-        masks = sorted(masks, key=lambda x: x.sum(), reverse=True)
-    for i, mask in enumerate(masks):
-        mask_combined[mask] = i + 1
-    return mask_combined
+    annotations = sorted(annotations, key=lambda x: x['area'], reverse=True)
+    return PackedMasks.pack(anno['segmentation'] for anno in annotations)
+
+
+def combine_bmasks(masks: PackedMasks | NumpyTensor['n h w'], sort=False) -> NumpyTensor['h w']:
+    """
+    Label image of masks, where later masks, or smaller masks if sort, overwrite earlier ones. Dense masks are packed first.
+    """
+    if not isinstance(masks, PackedMasks):
+        masks = PackedMasks.pack(np.asarray(masks))
+    order = np.argsort(-masks.areas(), kind='stable') if sort else None
+    return masks.combine(order)
 
 
 def decompose_mask(mask: NumpyTensor['h w'], background=0) -> NumpyTensor['n h w']:
@@ -43,23 +48,49 @@ def decompose_mask(mask: NumpyTensor['h w'], background=0) -> NumpyTensor['n h w
 def remove_artifacts(mask: NumpyTensor['h w'], mode: str, min_area=128) -> NumpyTensor['h w']:
     """
     Removes small islands/fill holes from a mask.
+
+    Bounding boxes of all labels are found in one sweep and each label is processed only within its box grown by a pixel
+    of margin. Components touching the margin continue outside the box, so they are never holes unless a strip outside
+    the box is smaller than min_area, in which case the label is processed over the whole mask.
     """
     assert mode in ['holes', 'islands']
     mode_holes = (mode == 'holes')
 
-    def remove_helper(bmask):
+    def remove_helper(bmask, margins: list[tuple]):
         # opencv connected components operates on binary masks only
         bmask = (mode_holes ^ bmask).astype(np.uint8)
         nregions, regions, stats, _ = cv2.connectedComponentsWithStats(bmask, 8)
-        sizes = stats[:, -1][1:]  # Row 0 corresponds to 0 pixels
-        fill = [i + 1 for i, s in enumerate(sizes) if s < min_area] + [0]
+        fill = stats[:, -1] < min_area
+        for margin in margins: # regions continuing outside the crop
+            fill[regions[margin]] = False
+        fill[0] = True # Row 0 corresponds to 0 pixels
         if not mode_holes:
-            fill = [i for i in range(nregions) if i not in fill]
-        return np.isin(regions, fill)
+            fill = ~fill
+        return fill[regions]
 
+    h, w = mask.shape
     mask_combined = np.zeros_like(mask)
-    for label in np.unique(mask): # also process background
-        mask_combined[remove_helper(mask == label)] = label
+    boxes = ndimage.find_objects(mask.astype(np.int64) + 1) # box of label l at index l
+    for label, box in enumerate(boxes): # also process background
+        if box is None:
+            continue
+        y, x = box
+        strips = [area for area in [y.start * w, (h - y.stop) * w, x.start * h, (w - x.stop) * h] if area > 0]
+        if mode_holes and len(strips) and min(strips) < min_area:
+            y0, y1, x0, x1 = 0, h, 0, w
+        else:
+            y0, y1, x0, x1 = max(y.start - 1, 0), min(y.stop + 1, h), max(x.start - 1, 0), min(x.stop + 1, w)
+
+        margins = []
+        if mode_holes:
+            margins = [
+                margin for exists, margin in [
+                    (y0 > 0, (0, slice(None))), (y1 < h, (-1, slice(None))),
+                    (x0 > 0, (slice(None), 0)), (x1 < w, (slice(None), -1)),
+                ] if exists
+            ]
+        fill = remove_helper(mask[y0:y1, x0:x1] == label, margins)
+        mask_combined[y0:y1, x0:x1][fill] = label
     return mask_combined
 
 
@@ -87,7 +118,7 @@ def colormap_bmask(bmask: NumpyTensor['h w']) -> Image.Image:
 
 
 def colormap_bmasks(
-    masks: NumpyTensor['n h w'], 
+    masks: PackedMasks | NumpyTensor['n h w'], 
     image: NumpyTensor['h w 3']=None, background=np.array([255, 255, 255]), blend=0.25
 ) -> Image.Image:
     """
@@ -96,25 +127,6 @@ def colormap_bmasks(
     return colormap_mask(mask, image, background=background, blend=blend)
 
 
-def point_grid_from_mask(mask: NumpyTensor['h w'], n: int) -> NumpyTensor['n 2']:
-    """
-    Sample points within valid mask normalized to [0, 1] x [0, 1]
-    """
-    valid = np.argwhere(mask)
-    if len(valid) == 0:
-        raise ValueError('No valid points in mask')
-
-    h, w = mask.shape
-    n = min(n, len(valid))
-    indices = np.random.choice(len(valid), n, replace=False)
-    samples = valid[indices].astype(float)
-    samples[:, 0] /= h - 1
-    samples[:, 1] /= w - 1
-    samples = samples[:, [1, 0]]
-    samples = samples[np.lexsort((samples[:, 1], samples[:, 0]))]
-    return samples
-
-
 class SamModel(nn.Module):
     """
     """
@@ -134,7 +146,10 @@ class SamModel(nn.Module):
 
     def setup_sam(self, mode='auto'):
         """
+        Imports segment_anything on first use, so the rest of the module does not depend on it.
         """
+        from segment_anything import SamAutomaticMaskGenerator, SamPredictor, sam_model_registry
+
         match = re.search(r'vit_(l|tiny|h)', self.config.sam.checkpoint)
         self.sam_model = sam_model_registry[match.group(0)](checkpoint=self.config.sam.checkpoint)
         self.sam_model = self.sam_model.to(self.device)
@@ -151,7 +166,7 @@ class SamModel(nn.Module):
             AutoProcessor.from_pretrained(self.config.grounding_dino.checkpoint), \
             AutoModel    .from_pretrained(self.config.grounding_dino.checkpoint).to(self.device)
 
-    def process_image(self, image: Image, prompt: dict = None) -> NumpyTensor['n h w']:
+    def process_image(self, image: Image, prompt: dict = None) -> PackedMasks:
         """
         For information on prompt format see:
         
@@ -165,10 +180,7 @@ class SamModel(nn.Module):
             self.engine.set_image(image)
             annotations = self.engine.predict(**prompt)[0]        
             annotations = [{'segmentation': m, 'area': m.sum().item()} for m in annotations]
-        
-        annotations = sorted(annotations, key=lambda x: x['area'], reverse=True)
-        masks = np.stack([anno['segmentation'] for anno in annotations])
-        return masks
+        return stack_annotations(annotations)
 
     def process_boxes(self, image: Image, texts: list[str]) -> tuple[
         list[NumpyTensor[4]],
@@ -188,7 +200,7 @@ class SamModel(nn.Module):
         )
         return boxes, logits
 
-    def forward(self, image: Image, texts: list[str]=None) -> NumpyTensor['n h w']:
+    def forward(self, image: Image, texts: list[str]=None) -> PackedMasks:
         """
         """
         if self.config.sam.auto:
@@ -198,7 +210,55 @@ class SamModel(nn.Module):
             masks = []
             for box in boxes:
                 masks.append(self.process_image(image, {'box': box}))
-            masks = np.concatenate(masks)
+            masks = PackedMasks.concatenate(masks)
+        return masks
+
+    def generate_refined(
+        self,
+        image: NumpyTensor['h w 3'],
+        generate: Callable[[NumpyTensor['n 2']], list[dict]],
+        point_grid: NumpyTensor['n 2'],
+        refine: Callable[[NumpyTensor['h w'], int], NumpyTensor['n 2'] | None]=None,
+    ) -> PackedMasks:
+        """
+        Generates annotations prompted by point_grid, then while refine, given the pixels covered by annotations so far and
+        the number of refinement rounds, returns more points, generates annotations prompted by them.
+        """
+        annotations = generate(point_grid)
+        covered = np.zeros(image.shape[:2], dtype=bool)
+        num_covered = 0
+        num_rounds = 0
+        while refine is not None:
+            for anno in annotations[num_covered:]:
+                covered |= anno['segmentation']
+            num_covered = len(annotations)
+            point_grid = refine(covered, num_rounds)
+            if point_grid is None:
+                break
+            annotations += generate(point_grid)
+            num_rounds += 1
+        return stack_annotations(annotations)
+
+    def forward_batch(
+        self,
+        images: list[Image],
+        point_grids: list[NumpyTensor['n 2']],
+        refine: Callable[[int, NumpyTensor['h w'], int], NumpyTensor['n 2'] | None]=None,
+    ) -> list[PackedMasks]:
+        """
+        Automatic masks of each image prompted by its point grid, normalized to [0, 1] x [0, 1]. If refine is given, it is
+        called with the index of the image for more points after each round of generation (see generate_refined). Requires
+        sam.auto, since point grids prompt the automatic mask generator.
+        """
+        if not self.config.sam.auto:
+            raise ValueError('forward_batch requires sam.auto, use process_image with prompts instead')
+        masks = []
+        for i, (image, point_grid) in enumerate(zip(images, point_grids)):
+            image = np.array(image)
+            def generate(point_grid, image=image):
+                self.engine.point_grids = [point_grid]
+                return self.engine.generate(image)
+            masks.append(self.generate_refined(image, generate, point_grid, refine and partial(refine, i)))
         return masks
 
 
@@ -207,7 +267,12 @@ class Sam2Model(SamModel):
     """
     def setup_sam(self, mode='auto'):
         """
+        Imports sam2 on first use, so the rest of the module does not depend on it.
         """
+        from sam2.build_sam import build_sam2
+        from sam2.sam2_image_predictor import SAM2ImagePredictor
+        from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+
         self.sam_model = build_sam2(self.config.sam.model_config, self.config.sam.checkpoint, device=self.device, apply_postprocessing=False)
         self.sam_model.eval()
         self.engine = {
@@ -215,6 +280,54 @@ class Sam2Model(SamModel):
             'auto': SAM2AutomaticMaskGenerator,
         }[mode](self.sam_model, **self.config.sam.get('engine_config', {}))
 
+    def forward_batch(
+        self,
+        images: list[Image],
+        point_grids: list[NumpyTensor['n 2']],
+        refine: Callable[[int, NumpyTensor['h w'], int], NumpyTensor['n 2'] | None]=None,
+    ) -> list[PackedMasks]:
+        """
+        Encodes sam.batch_size images at a time in one image encoder pass and generates the masks of each image from its
+        encoded features, so the automatic mask generator does not encode images one by one, including in refinement
+        rounds. Falls back to encoding each image with crop layers, which are encoded per crop. Requires sam.auto.
+
+        NOTE:: sets the private state of SAM2ImagePredictor, as of sam2 1.1.0.
+        """
+        if not self.config.sam.auto or self.engine.crop_n_layers > 0:
+            return super().forward_batch(images, point_grids, refine)
+
+        predictor = self.engine.predictor
+        missing = [name for name in PREDICTOR_STATE if not hasattr(predictor, name)]
+        if missing:
+            raise RuntimeError(f'SAM2ImagePredictor has no {missing}, forward_batch supports the state of sam2 1.1.0')
+        batch_size = self.config.sam.get('batch_size', 8)
+        masks = []
+        for be in range(0, len(images), batch_size):
+            batch = [np.array(image) for image in images[be:be + batch_size]]
+            predictor.set_image_batch(batch)
+            features, orig_hw = predictor._features, predictor._orig_hw
+            predictor.set_image = lambda image: None # generate sets the image, which is already encoded
+            def generate(point_grid, i, image):
+                predictor._features = { # generate resets the predictor, so features are set before every call
+                    'image_embed'   : features['image_embed'][i:i + 1],
+                    'high_res_feats': [feat[i:i + 1] for feat in features['high_res_feats']],
+                }
+                predictor._orig_hw = [orig_hw[i]]
+                predictor._is_image_set = True
+                predictor._is_batch = False
+                self.engine.point_grids = [point_grid]
+                return self.engine.generate(image)
+
+            try:
+                for i, (image, point_grid) in enumerate(zip(batch, point_grids[be:be + batch_size])):
+                    masks.append(self.generate_refined(
+                        image, partial(generate, i=i, image=image), point_grid, refine and partial(refine, be + i)
+                    ))
+            finally:
+                del predictor.set_image
+                predictor.reset_predictor()
+        return masks
+
 
 if __name__ == '__main__':
     import time
@@ -1,16 +1,17 @@
-import shutil
 import os
 import json
 import copy
 import multiprocessing as mp
-from collections import defaultdict, Counter
+from collections import deque
+from contextlib import closing
+from typing import Callable, Iterable, Iterator
 from pathlib import Path
 
 import numpy as np
 import torch
 import torch.nn as nn
-import trimesh
 import igraph
+from scipy import sparse
 from PIL import Image
 from omegaconf import OmegaConf
 from trimesh.base import Trimesh, Scene
@@ -19,24 +20,35 @@ from natsort import natsorted
 
 from samesh.data.common import NumpyTensor
 from samesh.data.loaders import read_scene, remove_texture, scene2mesh
-from samesh.renderer.renderer import Renderer, render_multiview, colormap_faces, colormap_norms
-from samesh.models.sam import SamModel, Sam2Model, combine_bmasks, colormap_mask, remove_artifacts, point_grid_from_mask
+from samesh.renderer.renderer import Renderer, render_multiview, render_multiview_iter, sample_multiview_poses, colormap_faces, colormap_norms
+from samesh.models.sam import SamModel, Sam2Model, combine_bmasks, colormap_mask, remove_artifacts
 from samesh.utils.cameras import *
-from samesh.utils.mesh import duplicate_verts
+from samesh.utils.cache import RENDER_CACHE_NAMES, RenderCacheWriter, StageCache, hash_key, load_render_cache, render_cache_exists
+from samesh.utils.graph import FaceGraph, label_components
+from samesh.utils.masks import PackedMasks, point_grid_from_mask, point_budget
+from samesh.utils.mesh import duplicate_verts, decimate_mesh, transfer_face_labels, hash_mesh
+from samesh.utils.shared import SharedArrays, SharedArrayDescriptors, attach_shared_arrays
 from samesh.models.shape_diameter_function import *
 
 
-def colormap_faces_mesh(mesh: Trimesh, face2label: dict[int, int], background=np.array([0, 0, 0])) -> Trimesh:
+UNLABELED = -1 # sentinel for faces without label in face2label arrays
+CACHE_STAGE_NAMES = { # kinds stored by each stage of the render cache
+    'renders': ['matte', 'sdf', 'faces', 'norms', 'norms_masked', 'poses'],
+    'masks'  : ['bmasks'],
+}
+
+
+def colormap_faces_mesh(mesh: Trimesh, face2label: NumpyTensor['f'], background=np.array([0, 0, 0])) -> Trimesh:
     """
     """
-    label_max = max(face2label.values())
+    label_max = int(face2label.max())
     palette = RandomState(0).randint(0, 255, (label_max + 1, 3)) # +1 for unlabeled faces
     palette[0] = background
     mesh = duplicate_verts(mesh) # needed to prevent face color interpolation
-    faces_colored = set()
-    for face, label in face2label.items():
-        mesh.visual.face_colors[face, :3] = palette[label]
-        faces_colored.add(face)
+    labeled = face2label != UNLABELED
+    face_colors = mesh.visual.face_colors.copy()
+    face_colors[labeled, :3] = palette[face2label[labeled]]
+    mesh.visual.face_colors = face_colors
     #print(np.unique(mesh.visual.face_colors, axis=0, return_counts=True))
     '''
     for face in range(len(mesh.faces)):
@@ -58,14 +70,14 @@ def extract_mesh(mesh: Trimesh, face2label: dict[int, int], background=np.array(
         
     return None
 
-def split_mesh_by_label(mesh: Trimesh, face2label: dict[int, int]) -> dict[int, Trimesh]:
+def split_mesh_by_label(mesh: Trimesh, face2label: NumpyTensor['f']) -> dict[int, Trimesh]:
     """
     원본 메시를 face2label 매핑을 기준으로 레이블별로 분리하여 서브 메시 딕셔너리를 반환.
     실제 색상은 적용하지 않으며, 기하학적 정보만 분리함.
     
     매개변수:
       mesh: 분리할 원본 Trimesh 객체.
-      face2label: 각 면의 인덱스를 키로, 해당 면에 부여할 레이블(정수)을 값으로 갖는 딕셔너리.
+      face2label: 각 면에 부여할 레이블(정수) 배열.
     
     반환값:
       레이블을 키로, 해당 레이블의 면들로 구성된 서브 메시(Trimesh 객체)를 값으로 갖는 딕셔너리.
@@ -75,10 +87,8 @@ def split_mesh_by_label(mesh: Trimesh, face2label: dict[int, int]) -> dict[int,
     
     # 레이블별로 면 인덱스 그룹화
     label2faces = {}
-    for face_idx, label in face2label.items():
-        if label not in label2faces:
-            label2faces[label] = []
-        label2faces[label].append(face_idx)
+    for label in np.unique(face2label[face2label != UNLABELED]):
+        label2faces[int(label)] = np.flatnonzero(face2label == label)
         
     # 레이블별 서브 메시 생성
     submeshes = {}
@@ -99,51 +109,161 @@ def norms_mask(norms: NumpyTensor['h w 3'], cam2world: NumpyTensor['4 4'], thres
     return np.abs(np.dot(norms, lookat)) > threshold
 
 
+def compute_norms_masked(norms: NumpyTensor['h w 3'], pose: NumpyTensor['4 4']) -> NumpyTensor['h w 3']:
+    """
+    """
+    valid = norms_mask(norms, pose)
+    norms_masked = norms.copy()
+    norms_masked[~valid] = np.array([1, 1, 1])
+    return norms_masked
+
+
+def load_item(path: Path, i: int) -> dict:
+    """
+    Loads view i of a cache written as per view files, before render caches were stacked (see samesh.utils.cache).
+    """
+    item = {
+        'matte' : Image.open(path / f'matte_{i}.png'),
+        'faces' : np.load(path / f'faces_{i}.npy'),
+        'norms' : np.load(path / f'norms_{i}.npy'),
+        'bmasks': np.load(path / f'bmask_{i}.npy'),
+        'cmasks': np.load(path / f'cmask_{i}.npy'),
+        'norms_masked': np.load(path / f'norms_mask_{i}.npy'),
+    }
+    if (path / f'sdf_{i}.png').exists():
+        item['sdf'] = Image.open(path / f'sdf_{i}.png')
+    return item
+
+
 def load_items(path: Path) -> dict[str, list]:
     """
+    Loads a render cache, whose views are memory mapped, or a cache of per view files.
     """
     print('Loading items from cache...')
+    if render_cache_exists(path):
+        return load_render_cache(path)
 
     filenames = list(path.glob('matte_*.png'))
     filenames = natsorted(filenames, key=lambda x: int(x.stem.split('_')[-1]))
-    items = {
-        'matte' : list(map(Image.open, filenames)),
-        'faces' : [np.load(path / f'faces_{i}.npy') for i in range(len(filenames))],
-        'norms' : [np.load(path / f'norms_{i}.npy') for i in range(len(filenames))],
-        'bmasks': [np.load(path / f'bmask_{i}.npy') for i in range(len(filenames))],
-        'cmasks': [np.load(path / f'cmask_{i}.npy') for i in range(len(filenames))],
-        'norms_masked': [np.load(path / f'norms_mask_{i}.npy') for i in range(len(filenames))],
-        'poses':  np.load(path / 'poses.npy')
-    }
-    try:
-        filenames = list(path.glob('sdf_*.png'))
-        filenames = natsorted(filenames, key=lambda x: int(x.stem.split('_')[-1]))
-        items['sdf'] = list(map(Image.open, filenames))
-    except FileNotFoundError:
-        pass
+    items = [load_item(path, i) for i in range(len(filenames))]
+    items = {name: [item[name] for item in items] for name in items[0].keys()}
+    items['poses'] = np.load(path / 'poses.npy')
     return items
 
 
-def save_items(items: dict, path: Path) -> None:
+def iter_items(path: Path) -> Iterator[dict]:
+    """
+    Yields cached views one at a time, reading only the view being yielded.
+    """
+    if render_cache_exists(path):
+        items = load_render_cache(path)
+        for i in range(len(items['poses'])):
+            yield {name: views[i] for name, views in items.items()}
+        return
+
+    poses = np.load(path / 'poses.npy')
+    for i, pose in enumerate(poses):
+        item = load_item(path, i)
+        item['poses'] = pose
+        yield item
+
+
+def save_items(items: dict, path: Path, compress=False) -> None:
     """
     """
     print('Saving items to cache...')
 
-    for i, image in enumerate(items['matte']):
-        image.save(path / f'matte_{i}.png')
-    if 'sdf' in items:
-        for i, image in enumerate(items['sdf']):
-            image.save(path / f'sdf_{i}.png')
-    
-    for i, (faces, bmask, cmask, norms, norms_masked) in enumerate(
-        zip(items['faces'], items['bmasks'], items['cmasks'], items['norms'], items['norms_masked'])
-    ):
-        np.save(path / f'faces_{i}.npy', faces)
-        np.save(path / f'bmask_{i}.npy', bmask)
-        np.save(path / f'cmask_{i}.npy', cmask)
-        np.save(path / f'norms_{i}.npy', norms)
-        np.save(path / f'norms_mask_{i}.npy', norms_masked)
-    np.save(path / 'poses.npy', items['poses'])
+    names = [name for name in RENDER_CACHE_NAMES if name in items]
+    with RenderCacheWriter(path, compress=compress) as writer:
+        for i in range(len(items[names[0]])):
+            writer.append({name: items[name][i] for name in names})
+
+
+def select_stage(items: dict, stage: str) -> dict:
+    """
+    Returns the kinds of items stored by stage of the render cache.
+    """
+    return {name: items[name] for name in CACHE_STAGE_NAMES[stage] if name in items}
+
+
+def load_face2label_views(path: Path) -> list[sparse.coo_matrix]:
+    """
+    """
+    data = np.load(path / 'face2label.npz')
+    offsets = np.concatenate([[0], np.cumsum(data['counts'], dtype=np.int64)])
+    return [
+        sparse.coo_matrix((data['data'][be:en], (data['rows'][be:en], data['cols'][be:en])), shape=tuple(shape))
+        for be, en, shape in zip(offsets[:-1], offsets[1:], data['shapes'])
+    ]
+
+
+def save_face2label_views(face2label_views: list[sparse.coo_matrix], path: Path) -> None:
+    """
+    """
+    face2label_views = [face2label.tocoo() for face2label in face2label_views]
+    np.savez(
+        path / 'face2label.npz',
+        rows  =np.concatenate([face2label.row  for face2label in face2label_views]),
+        cols  =np.concatenate([face2label.col  for face2label in face2label_views]),
+        data  =np.concatenate([face2label.data for face2label in face2label_views]),
+        counts=np.array([face2label.nnz   for face2label in face2label_views]),
+        shapes=np.array([face2label.shape for face2label in face2label_views]),
+    )
+
+
+def compute_cache_keys(tmesh: Trimesh, config: OmegaConf) -> dict[str, str]:
+    """
+    Returns the content addressed cache key of each stage, which chains the key of the stage it depends on with the settings
+    that affect it, so changing a setting only invalidates the stages from the first one using it onwards.
+    """
+    container = lambda node: OmegaConf.to_container(node, resolve=True) if OmegaConf.is_config(node) else node
+    settings  = lambda *names: {name: container(config.sam_mesh.get(name, None)) for name in names}
+    use_modes = list(config.sam_mesh.use_modes)
+    keys = {'graph': hash_mesh(tmesh)}
+    keys['renders'] = hash_key(keys['graph'], container(config.renderer), 'sdf' in use_modes)
+    keys['masks'] = hash_key(
+        keys['renders'], container(config.sam), use_modes, settings('adaptive_points', 'adaptive_coverage', 'adaptive_rounds')
+    )
+    keys['face2label'] = hash_key(keys['masks'], settings('min_area', 'face2label_threshold'))
+    keys['lift'] = hash_key(keys['face2label'], settings(
+        'connections_threshold', 'counter_lens_threshold_min', 'connections_bin_resolution',
+        'connections_bin_threshold_percentage', 'repartition_soft'
+    ))
+    keys['smooth'] = hash_key(keys['lift'], settings(
+        'smoothing_threshold_percentage_size', 'smoothing_threshold_percentage_area', 'smoothing_iterations'
+    ))
+    keys['split'] = hash_key(keys['smooth'])
+    return keys
+
+
+def load_checkpoint(path: Path) -> dict:
+    """
+    """
+    outputs = {'face2label': np.load(path / 'face2label.npy'), 'likelihoods': None}
+    if (path / 'likelihoods.npz').exists():
+        outputs['likelihoods'] = sparse.load_npz(path / 'likelihoods.npz')
+    return outputs
+
+
+def save_checkpoint(outputs: dict, path: Path) -> None:
+    """
+    Saves face2label as int32 and likelihoods, if any, as sparse float32.
+    """
+    np.save(path / 'face2label.npy', np.asarray(outputs['face2label'], dtype=np.int32))
+    if outputs.get('likelihoods') is not None:
+        sparse.save_npz(path / 'likelihoods.npz', sparse.csr_matrix(outputs['likelihoods'], dtype=np.float32))
+
+
+def visualize_item(item: dict, path: Path, i: int) -> None:
+    """
+    """
+    item['matte'].save(f'{path}/matte_{i}.png')
+    if 'sdf' in item:
+        item['sdf'].save(f'{path}/sdf_{i}.png')
+    colormap_faces(item['faces']).save(f'{path}/faces_{i}.png')
+    colormap_mask (item['cmasks']).save(f'{path}/masks_{i}.png')
+    colormap_norms(item['norms']).save(f'{path}/norms_{i}.png')
+    colormap_norms(item['norms_masked']).save(f'{path}/norms_mask_{i}.png')
 
 
 def visualize_items(items: dict, path: Path) -> None:
@@ -151,20 +271,10 @@ def visualize_items(items: dict, path: Path) -> None:
     """
     os.makedirs(path, exist_ok=True)
 
-    for i, image in tqdm(enumerate(items['matte']), 'Visualizing images'):
-        image.save(f'{path}/matte_{i}.png')
-    if 'sdf' in items:
-        for i, image in tqdm(enumerate(items['sdf']), 'Visualizing SDF'):
-            image.save(f'{path}/sdf_{i}.png')
-    
-    for i, faces in tqdm(enumerate(items['faces']), 'Visualizing FaceIDs'):
-        colormap_faces(faces).save(f'{path}/faces_{i}.png')
-    for i, cmask in tqdm(enumerate(items['cmasks']), 'Visualizing SAM Masks'):
-        colormap_mask (cmask).save(f'{path}/masks_{i}.png')
-    for i, norms in tqdm(enumerate(items['norms']), 'Visualizing Normals'):
-        colormap_norms(norms).save(f'{path}/norms_{i}.png')
-    for i, norms_masked in tqdm(enumerate(items['norms_masked']), 'Visualizing Normals Mask'):
-        colormap_norms(norms_masked).save(f'{path}/norms_mask_{i}.png')
+    names = ['matte', 'sdf', 'faces', 'cmasks', 'norms', 'norms_masked']
+    names = [name for name in names if name in items]
+    for i in tqdm(range(len(items['faces'])), 'Visualizing items'):
+        visualize_item({name: items[name][i] for name in names}, path, i)
 
 
 """
@@ -176,44 +286,151 @@ def compute_face2label(
     mask  : NumpyTensor['h w'],
     norms : NumpyTensor['h w 3'],
     pose  : NumpyTensor['4 4'], 
-    label_sequence_count: int, threshold_counts: int=16
-):
+    label_sequence_count: int, threshold_counts: int=16, num_faces: int=None
+) -> sparse.coo_matrix:
     """
+    Computes (face, label) pixel counts of a view in a single pass. Rows are faces and columns are labels offset by 
+    label_sequence_count. Pairs covered by at most threshold_counts pixels are dropped.
     """
     #print(f'Computing face2label starting with {label_sequence_count}')
 
-    normal_mask = norms_mask(norms, pose)
+    if num_faces is None:
+        num_faces = int(faceid.max()) + 1
+    shape = (num_faces, label_sequence_count + len(labels))
+    if len(labels) == 0:
+        return sparse.coo_matrix(shape, dtype=np.int64)
+
+    # map mask values to label indices, discarding pixels whose value is not in labels
+    labels = np.asarray(labels)
+    order  = np.argsort(labels)
+    valid  = norms_mask(norms, pose) & (faceid != -1) # remove background
+    values = mask[valid]
+    index  = np.clip(np.searchsorted(labels[order], values), 0, len(labels) - 1)
+    member = labels[order][index] == values
+    faces  = faceid[valid][member].astype(np.int64)
+    index  = order[index[member]]
+
+    # single pass (face, label) histogram over combined keys
+    keys, counts = np.unique(faces * len(labels) + index, return_counts=True)
+    keys   = keys  [counts > threshold_counts]
+    counts = counts[counts > threshold_counts]
+    return sparse.coo_matrix((counts, (keys // len(labels), label_sequence_count + keys % len(labels))), shape=shape)
+
+
+def compute_face2label_shared(
+    descriptors: SharedArrayDescriptors, index: int, labels: NumpyTensor['l'], *args, **kwargs
+) -> sparse.coo_matrix:
+    """
+    Computes face2label for view index of the faces, cmasks, norms and poses published by SharedArrays.
+    """
+    views = attach_shared_arrays(descriptors)
+    return compute_face2label(
+        labels, views['faces'][index], views['cmasks'][index], views['norms'][index], views['poses'][index], *args, **kwargs
+    )
+
 
-    face2label = defaultdict(Counter)
-    for j, label in enumerate(labels):
-        label_sequence = label_sequence_count + j
-        faces_mask = (mask == label) & normal_mask
-        faces, counts = np.unique(faceid[faces_mask], return_counts=True)
-        faces = faces[counts > threshold_counts]
-        faces = faces[faces != -1] # remove background
-        for face in faces:
-            face2label[int(face)][label_sequence] += np.sum(faces_mask & (faceid == face))
-    return face2label
+def repartition_shared(
+    descriptors: SharedArrayDescriptors, smoothing_iterations: int, _lambda: float, **kwargs
+) -> NumpyTensor['f']:
+    """
+    Repartitions the face adjacency, partition and costs published by SharedArrays with the given lambda.
+    """
+    arrays = attach_shared_arrays(descriptors)
+    return repartition(
+        arrays['face_adjacency'], arrays['partition'].copy(), arrays['cost_data'], arrays['cost_smoothness'], smoothing_iterations, _lambda,
+        **kwargs
+    )
 
 
-def compute_connections(i: int, j: int, face2label1: dict, face2label2: dict, counter_threshold=32):
+def compute_face2label_majority(face2label: sparse.spmatrix) -> NumpyTensor['f']:
+    """
+    Returns the label with highest count for each face, breaking ties by smallest label, and -1 for faces without labels.
     """
+    face2label = face2label.tocoo()
+    order = np.lexsort((face2label.col, -face2label.data, face2label.row))
+    rows = face2label.row[order]
+    cols = face2label.col[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = rows[1:] != rows[:-1]
+    face2label_majority = np.full(face2label.shape[0], UNLABELED, dtype=np.int32)
+    face2label_majority[rows[first]] = cols[first]
+    return face2label_majority
+
+
+def compute_connections(
+    face2label_views: list[NumpyTensor['f']], num_labels: int, counter_threshold=32
+) -> tuple[sparse.csr_matrix, NumpyTensor['l']]:
     """
-    #print(f'Computing partial connection ratios for {i} and {j}')
+    Computes label connection counts for all view pairs at once, where the connection count of two labels is the number of
+    faces on which both are the majority label of their respective views. Counts are the off diagonal entries of the Gram
+    matrix of the face x label incidence matrix built from the per view majority labels (-1 for unlabeled faces).
+
+    Returns connections with counts above counter_threshold and mask of labels with any connection prior to thresholding.
+    """
+    rows = np.concatenate([np.flatnonzero(face2label != UNLABELED) for face2label in face2label_views])
+    cols = np.concatenate([face2label[face2label != UNLABELED]    for face2label in face2label_views])
+    num_faces = len(face2label_views[0])
+    incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)), shape=(num_faces, num_labels))
+
+    # labels of the same view never share a face, so only the diagonal needs to be removed
+    connections = (incidence.T @ incidence).tocsr()
+    connections.setdiag(0)
+    connections.eliminate_zeros()
+    connected = connections.getnnz(axis=1) > 0
 
-    connections = defaultdict(Counter)
-    face2label1_common = {face: counter.most_common(1)[0][0] for face, counter in face2label1.items()}
-    face2label2_common = {face: counter.most_common(1)[0][0] for face, counter in face2label2.items()}
-    for face1, label1 in face2label1_common.items():
-        for face2, label2 in face2label2_common.items():
-            if face1 != face2:
-                continue
-            connections[label1][label2] += 1
-            connections[label2][label1] += 1
     # remove connections where # overlapping faces is below threshold
-    for label1, counter in connections.items():
-        connections[label1] = {k: v for k, v in counter.items() if v > counter_threshold}
-    return connections
+    connections.data[connections.data <= counter_threshold] = 0
+    connections.eliminate_zeros()
+    return connections, connected
+
+
+def compute_face2label_likelihoods(
+    face2label_views: list[NumpyTensor['f']], hooks: NumpyTensor['l'], num_labels: int
+) -> sparse.csr_matrix:
+    """
+    Returns for each face the fraction of views labeling it whose majority label maps to each consistent label through hooks.
+    """
+    rows = np.concatenate([np.flatnonzero(face2label != UNLABELED)     for face2label in face2label_views])
+    cols = np.concatenate([hooks[face2label[face2label != UNLABELED]] for face2label in face2label_views])
+    num_faces = len(face2label_views[0])
+    likelihoods = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(num_faces, num_labels))
+    likelihoods.data /= np.repeat(np.asarray(likelihoods.sum(axis=1)).reshape(-1), np.diff(likelihoods.indptr))
+    return likelihoods
+
+
+def relabel_likelihoods(
+    likelihoods: sparse.spmatrix, face2label_prev: NumpyTensor['f'], face2label: NumpyTensor['f']
+) -> sparse.csr_matrix:
+    """
+    Moves the likelihood of each face for its previous label to its current label e.g. after split renames components.
+    """
+    likelihoods = likelihoods.tocoo()
+    rows, cols = likelihoods.row, likelihoods.col.copy()
+    moved = cols == face2label_prev[rows]
+    cols[moved] = face2label[rows[moved]]
+    num_labels = max(likelihoods.shape[1], int(face2label.max()) + 1)
+    return sparse.csr_matrix((likelihoods.data, (rows, cols)), shape=(likelihoods.shape[0], num_labels))
+
+
+def compute_cost_data(partition: NumpyTensor['f'], likelihoods: sparse.spmatrix | NumpyTensor['f l']=None) -> NumpyTensor['f l']:
+    """
+    Returns the data cost of assigning each face each label, which is the one hot complement of partition or, if given, the
+    complement of per face label likelihoods, where faces without likelihoods fall back to the former.
+    """
+    num_faces, num_labels = len(partition), int(np.max(partition)) + 1
+    cost_data = np.ones((num_faces, num_labels))
+    cost_data[np.arange(num_faces), partition] = 0
+    if likelihoods is None:
+        return cost_data
+
+    # labels not in partition are never expanded, so their columns are dropped before densifying
+    if sparse.issparse(likelihoods):
+        likelihoods = sparse.csr_matrix(likelihoods)[:, :num_labels].toarray()
+    else:
+        likelihoods = np.asarray(likelihoods)[:, :num_labels]
+    voted = likelihoods.sum(axis=1) > 0
+    cost_data[voted, :likelihoods.shape[1]] = 1 - likelihoods[voted]
+    return cost_data
 
 
 class SamModelMesh(nn.Module):
@@ -226,8 +443,88 @@ class SamModelMesh(nn.Module):
         self.config = config
         self.config.cache = Path(config.cache) if config.cache is not None else None
         self.renderer = Renderer(config.renderer)
-        if use_sam and (self.config.cache is None or not self.config.cache.exists() or self.config.cache_overwrite):
-            self.sam = Sam2Model(config.sam, device=device)
+        self.device = device
+        self.use_sam = use_sam
+        self._sam = None
+        self.renderer_sdf = None # created on first use by render_stream
+        self._pool = None
+        self.face2label_likelihoods = None # set by lift_views if sam_mesh.repartition_soft
+
+    @property
+    def sam(self) -> Sam2Model:
+        """
+        SAM model, loaded on first use so meshes whose masks are cached never load it.
+        """
+        if self._sam is None:
+            if not self.use_sam:
+                raise RuntimeError('SAM masks are not cached but SAM is disabled')
+            self._sam = Sam2Model(self.config.sam, device=self.device)
+        return self._sam
+
+    @property
+    def cache(self) -> StageCache | None:
+        """
+        Content addressed cache under config.cache, bounded by config.cache_max_gb if given.
+        """
+        if self.config.cache is None:
+            return None
+        max_gb = self.config.get('cache_max_gb', None)
+        return StageCache(self.config.cache, max_bytes=int(max_gb * 2 ** 30) if max_gb is not None else None)
+
+    def cache_lookup(self, stage: str) -> Path | None:
+        """
+        Returns the cache entry of stage for the loaded mesh, or None if it is not cached or cache_overwrite is set.
+        """
+        if self.cache is None or self.config.get('cache_overwrite', False):
+            return None
+        return self.cache.lookup(stage, self.cache_keys[stage])
+
+    def checkpoint(self, stage: str, compute: Callable[[], dict]) -> dict:
+        """
+        Returns the face2label and likelihoods output by stage, loaded from its checkpoint in the cache if present, otherwise
+        computed and checkpointed. Since compute only runs on a miss, stages that compute from the checkpoint of the
+        previous stage resume from the latest valid checkpoint.
+        """
+        path = self.cache_lookup(stage)
+        if path is not None:
+            print('Resuming from ', stage, ' checkpoint')
+            return load_checkpoint(path)
+        outputs = compute()
+        self.cache_save(stage, lambda path: save_checkpoint(outputs, path))
+        return outputs
+
+    def cache_save(self, stage: str, save: Callable[[Path], None]) -> None:
+        """
+        Creates the cache entry of stage for the loaded mesh, writes it with save and commits it.
+        """
+        cache = self.cache
+        if cache is None:
+            return
+        save(cache.create(stage, self.cache_keys[stage]))
+        cache.commit(stage, self.cache_keys[stage])
+
+    @property
+    def pool(self):
+        """
+        Worker pool for the lift and repartition stages, created on first use and kept across meshes until close is called.
+        """
+        if self._pool is None:
+            self._pool = mp.Pool(self.config.sam_mesh.get('num_workers', mp.cpu_count()))
+        return self._pool
+
+    def close(self):
+        """
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def load(self, scene: Scene, mesh_graph=True):
         """
@@ -236,21 +533,19 @@ class SamModelMesh(nn.Module):
         self.renderer.set_camera()
 
         if mesh_graph:
-            self.mesh_edges = trimesh.graph.face_adjacency(mesh=self.renderer.tmesh)
-            self.mesh_graph = defaultdict(set)
-            for face1, face2 in self.mesh_edges:
-                self.mesh_graph[face1].add(face2)
-                self.mesh_graph[face2].add(face1)
+            self.cache_keys = compute_cache_keys(self.renderer.tmesh, self.config)
+            path = self.cache_lookup('graph')
+            if path is not None:
+                self.mesh_graph = FaceGraph.load(path / 'face_graph.npz')
+            else:
+                self.mesh_graph = FaceGraph.from_mesh(self.renderer.tmesh)
+                self.cache_save('graph', lambda path: self.mesh_graph.save(path / 'face_graph.npz'))
+            self.mesh_edges = self.mesh_graph.edges
 
     def render(self, scene: Scene, visualize_path=None) -> dict[str, NumpyTensor]:
         """
+        Renders views and computes their SAM masks, loading the renders and masks stages from the cache when present.
         """
-        if self.config.cache is not None and self.config.cache.exists():
-            if self.config.cache_overwrite:
-                shutil.rmtree(self.config.cache)
-            else:
-                return load_items(self.config.cache)
-
         def render_func(uv_map=False):
             renderer_args = self.config.renderer.renderer_args.copy()
             if uv_map:
@@ -263,158 +558,247 @@ class SamModelMesh(nn.Module):
                 lighting_args=self.config.renderer.lighting_args,
             )
 
-        def compute_norms_masked(norms: NumpyTensor['h w 3'], pose: NumpyTensor['4 4']):
-            """
-            """
-            valid = norms_mask(norms, pose)
-            norms_masked = norms.copy()
-            norms_masked[~valid] = np.array([1, 1, 1])
-            return norms_masked
-        
-        renders = render_func()
-        renders['norms_masked'] = [
-            compute_norms_masked(norms, pose) for norms, pose in zip(renders['norms'], renders['poses'])
-        ]
+        compress = self.config.get('cache_compress', False)
+        path = self.cache_lookup('renders')
+        if path is not None:
+            renders = load_items(path)
+        else:
+            renders = render_func()
+            renders['norms_masked'] = [
+                compute_norms_masked(norms, pose) for norms, pose in zip(renders['norms'], renders['poses'])
+            ]
+            if 'sdf' in self.config.sam_mesh.use_modes:
+                self.load(self.prep_mesh_sdf(scene), mesh_graph=False)
+                renders['sdf'] = render_func(uv_map=True)['matte']
+                self.load(scene, mesh_graph=False) # restore original scene
+            self.cache_save('renders', lambda path: save_items(select_stage(renders, 'renders'), path, compress=compress))
+
+        path = self.cache_lookup('masks')
+        if path is not None:
+            renders['bmasks'] = load_items(path)['bmasks']
+        else:
+            # all views of all modes are segmented in one batched call
+            images = []
+            if 'norms' in self.config.sam_mesh.use_modes:
+                images.extend(colormap_norms(norms) for norms in renders['norms'])
+            if 'sdf' in self.config.sam_mesh.use_modes:
+                images.extend(renders['sdf'])
+            if 'matte' in self.config.sam_mesh.use_modes: # default matte render
+                images.extend(renders['matte'])
+
+            n = len(renders['faces'])
+            m = len(images) // n
+            print('Computing SAM Masks for ', m, ' modes of ', n, ' views')
+            bmasks_list = self.call_sam_batch(images, [faces != -1 for faces in renders['faces']] * m)
+            bmasks = [
+                PackedMasks.concatenate([bmasks_list[j * n + i] for j in range(m)]) 
+                for i in range(n)
+            ]
+            renders['bmasks'] = bmasks
+            self.cache_save('masks', lambda path: save_items(select_stage(renders, 'masks'), path, compress=compress))
 
-        def call_sam(image: Image, mask: NumpyTensor['h w']):
-            """
-            """
-            self.sam.engine.point_grids = \
-                [point_grid_from_mask(mask, self.config.sam.sam.engine_config.points_per_side ** 2)]
-            return self.sam(image)
+        renders['cmasks'] = [self.compute_cmask(masks, faces) for masks, faces in zip(renders['bmasks'], renders['faces'])]
+        if visualize_path is not None:
+            visualize_items(renders, visualize_path)
+        return renders
+
+    def render_stream(self, scene: Scene, visualize_path=None) -> Iterator[dict[str, NumpyTensor]]:
+        """
+        Streaming counterpart of render that renders and segments one view at a time, yielding each view as soon as its
+        masks are computed. Cached stages are loaded lazily and missing stages are written as views are computed.
+        """
+        if visualize_path is not None:
+            os.makedirs(visualize_path, exist_ok=True)
+
+        path_renders = self.cache_lookup('renders')
+        path_masks   = self.cache_lookup('masks')
+        if path_renders is not None:
+            renders = iter_items(path_renders)
+        else:
+            poses = sample_multiview_poses(
+                self.config.renderer.camera_generation_method, self.config.renderer.sampling_args
+            )
+            renders = render_multiview_iter(self.renderer, renderer_args=self.config.renderer.renderer_args.copy(), poses=poses)
+            if 'sdf' in self.config.sam_mesh.use_modes:
+                # sdf views are rendered alongside the original views by a second renderer
+                if self.renderer_sdf is None:
+                    self.renderer_sdf = Renderer(self.config.renderer)
+                self.renderer_sdf.set_object(self.prep_mesh_sdf(scene))
+                self.renderer_sdf.set_camera()
+                renderer_args = self.config.renderer.renderer_args.copy()
+                renderer_args['uv_map'] = True # handle cases like sdf
+                renders_sdf = render_multiview_iter(self.renderer_sdf, renderer_args=renderer_args, poses=poses, verbose=False)
+        masks = iter_items(path_masks) if path_masks is not None else None
+
+        cache = self.cache
+        writers = {}
+        try:
+            if cache is not None:
+                for stage, path in [('renders', path_renders), ('masks', path_masks)]:
+                    if path is None:
+                        writers[stage] = RenderCacheWriter(
+                            cache.create(stage, self.cache_keys[stage]), compress=self.config.get('cache_compress', False)
+                        )
+
+            for i, item in enumerate(renders):
+                if path_renders is None:
+                    item['norms_masked'] = compute_norms_masked(item['norms'], item['poses'])
+                    if 'sdf' in self.config.sam_mesh.use_modes:
+                        item['sdf'] = next(renders_sdf)['matte']
+                if masks is not None:
+                    item['bmasks'] = next(masks)['bmasks']
+                else:
+                    images = []
+                    if 'norms' in self.config.sam_mesh.use_modes:
+                        images.append(colormap_norms(item['norms']))
+                    if 'sdf' in self.config.sam_mesh.use_modes:
+                        images.append(item['sdf'])
+                    if 'matte' in self.config.sam_mesh.use_modes: # default matte render
+                        images.append(item['matte'])
+                    bmasks = self.call_sam_batch(images, [item['faces'] != -1] * len(images)) # modes of a view in one batch
+                    item['bmasks'] = PackedMasks.concatenate(bmasks)
+                item['cmasks'] = self.compute_cmask(item['bmasks'], item['faces'])
+
+                for stage, writer in writers.items():
+                    writer.append(select_stage(item, stage))
+                if visualize_path is not None:
+                    visualize_item(item, visualize_path, i)
+                yield item
+
+            for stage in list(writers):
+                writers[stage].close()
+                cache.commit(stage, self.cache_keys[stage])
+                del writers[stage]
+        finally:
+            # stream raised or was closed before its last view, so partial entries are removed
+            for stage, writer in writers.items():
+                writer.abort()
+                cache.discard(stage, self.cache_keys[stage])
+
+    def prep_mesh_sdf(self, scene: Scene) -> Trimesh:
+        """
+        """
+        #scene_sdf = remove_texture(scene)
+        tmesh_sdf = prep_mesh_shape_diameter_function(scene)
+        tmesh_sdf = colormap_shape_diameter_function(tmesh_sdf, sdf_values=shape_diameter_function(tmesh_sdf))
+        return tmesh_sdf
 
-        bmasks_list = []
+    def call_sam(self, image: Image, mask: NumpyTensor['h w']) -> PackedMasks:
+        """
+        """
+        return self.call_sam_batch([image], [mask])[0]
 
-        if 'norms' in self.config.sam_mesh.use_modes:
-            images1 = [colormap_norms(norms) for norms in renders['norms']]
-            bmasks1 = [
-                call_sam(image, faces != -1) for image, faces in \
-                    tqdm(zip(images1, renders['faces']), 'Computing SAM Masks for norms')
-            ]
-            bmasks_list.extend(bmasks1)
-
-        if 'sdf' in self.config.sam_mesh.use_modes:
-            #scene_sdf = remove_texture(scene)
-            tmesh_sdf = prep_mesh_shape_diameter_function(scene)
-            tmesh_sdf = colormap_shape_diameter_function(tmesh_sdf, sdf_values=shape_diameter_function(tmesh_sdf))
-            self.load(tmesh_sdf)
-            renders_sdf = render_func(uv_map=True)
-            images2 = renders_sdf['matte']
-
-            bmasks2 = [
-                call_sam(image, faces != -1) for image, faces in \
-                    tqdm(zip(images2, renders['faces']), 'Computing SAM Masks for sdf')
-            ]
-            bmasks_list.extend(bmasks2)
-            renders['sdf'] = renders_sdf['matte']
-
-        if 'matte' in self.config.sam_mesh.use_modes: # default matte render
-            images3 = renders['matte']
-            bmasks3 = [
-                call_sam(image, faces != -1) for image, faces in \
-                    tqdm(zip(images3, renders['faces']), 'Computing SAM Masks for matte')
-            ]
-            bmasks_list.extend(bmasks3)
+    def call_sam_batch(self, images: list[Image], masks: list[NumpyTensor['h w']]) -> list[PackedMasks]:
+        """
+        SAM masks of each image prompted by points sampled within its mask, with images encoded in batches.
+
+        If sam_mesh.adaptive_points, each mask gets points at the density of the full grid over the image, so small objects
+        get fewer prompts, and after each round points are sampled again only in the part of the mask not yet covered by
+        SAM masks, until sam_mesh.adaptive_coverage of it is covered or after sam_mesh.adaptive_rounds more rounds.
+        """
+        points_per_side = self.config.sam.sam.engine_config.points_per_side
+        if not self.config.sam_mesh.get('adaptive_points', False):
+            point_grids = [point_grid_from_mask(mask, points_per_side ** 2) for mask in masks]
+            return self.sam.forward_batch(images, point_grids)
+
+        coverage   = self.config.sam_mesh.get('adaptive_coverage', 0.95)
+        max_rounds = self.config.sam_mesh.get('adaptive_rounds', 3)
+
+        def refine(i: int, covered: NumpyTensor['h w'], num_rounds: int) -> NumpyTensor['n 2'] | None:
+            uncovered = masks[i] & ~covered
+            if num_rounds >= max_rounds or np.count_nonzero(uncovered) <= (1 - coverage) * np.count_nonzero(masks[i]):
+                return None
+            return point_grid_from_mask(uncovered, point_budget(uncovered, points_per_side))
 
-        self.load(scene) # restore original scene
+        point_grids = [point_grid_from_mask(mask, point_budget(mask, points_per_side)) for mask in masks]
+        return self.sam.forward_batch(images, point_grids, refine)
 
-        n = len(renders['faces'])
-        m = len(bmasks_list) // n
-        bmasks = [
-            np.concatenate([bmasks_list[j * n + i] for j in range(m)], axis=0) 
-            for i in range(n)
-        ]
-        cmasks = [combine_bmasks(masks, sort=True) for masks in bmasks]
+    def compute_cmask(self, bmasks: PackedMasks, faces: NumpyTensor['h w']) -> NumpyTensor['h w']:
+        """
+        """
+        cmask = combine_bmasks(bmasks, sort=True)
         # sometimes SAM doesn't separate body from background, so we have extra step to remove background using faceids
-        for cmask, faces in zip(cmasks, renders['faces']):
-            cmask += 1
-            cmask[faces == -1] = 0
+        cmask += 1
+        cmask[faces == -1] = 0
         min_area = self.config.sam_mesh.get('min_area', 1024)
-        cmasks = [remove_artifacts(mask, mode='islands', min_area=min_area) for mask in cmasks]
-        cmasks = [remove_artifacts(mask, mode='holes'  , min_area=min_area) for mask in cmasks]
-        renders['bmasks'] = bmasks
-        renders['cmasks'] = cmasks
-
-        if self.config.cache is not None:
-            self.config.cache.mkdir(parents=True)
-            save_items(renders, self.config.cache)
-        if visualize_path is not None:
-            visualize_items(renders, visualize_path)
-        return renders
+        cmask = remove_artifacts(cmask, mode='islands', min_area=min_area)
+        cmask = remove_artifacts(cmask, mode='holes'  , min_area=min_area)
+        return cmask
     
     def lift(self, renders: dict[str, NumpyTensor]) -> dict:
         """
         """
-        be, en = 0, len(renders['faces'])
-        renders = {k: [v[i] for i in range(be, en) if len(v)] for k, v in renders.items()}
-
-        print('Computing face2label for each view on ', mp.cpu_count(), ' cores')
+        print('Computing face2label for each view on ', self.config.sam_mesh.get('num_workers', mp.cpu_count()), ' cores')
+        num_faces = len(self.renderer.tmesh.faces)
         label_sequence_count = 1 # background is 0
         args = []
-        for faceid, cmask, norms, pose in zip(
-            renders['faces'],
-            renders['cmasks'],
-            renders['norms'],
-            renders['poses'],
-        ):
+        for i, cmask in enumerate(renders['cmasks']):
             labels = np.unique(cmask)
             labels = labels[labels != 0] # remove background
-            args.append((labels, faceid, cmask, norms, pose, label_sequence_count, self.config.sam_mesh.get('face2label_threshold', 16)))
+            args.append((i, labels, label_sequence_count, self.config.sam_mesh.get('face2label_threshold', 16), num_faces))
             label_sequence_count += len(labels)
-        
-        with mp.Pool(mp.cpu_count()) as pool:
-            face2label_views = pool.starmap(compute_face2label, args)
-        
-        print('Building match graph on ', mp.cpu_count(), ' cores')
-        args = []
-        for i, face2label1 in enumerate(face2label_views):
-            for j, face2label2 in enumerate(face2label_views):
-                if i < j:
-                    args.append((i, j, face2label1, face2label2, self.config.sam_mesh.get('connections_threshold', 32)))
-        
-        with mp.Pool(mp.cpu_count()) as pool:
-            partial_connections = pool.starmap(compute_connections, args)
 
-        connections_ratios = defaultdict(Counter)
-        for c in partial_connections:
-            for label1, counter in c.items():
-                connections_ratios[label1].update(counter)
-    
+        # publish views once so workers only receive view indices
+        with SharedArrays({name: renders[name] for name in ['faces', 'cmasks', 'norms', 'poses']}) as shared:
+            face2label_views = self.pool.starmap(compute_face2label_shared, [(shared.descriptors, *arg) for arg in args])
+        self.cache_save('face2label', lambda path: save_face2label_views(face2label_views, path))
+        return self.lift_views(face2label_views)
+
+    def lift_stream(self, renders: Iterable[dict[str, NumpyTensor]]) -> dict:
+        """
+        Streaming counterpart of lift that computes face2label for each view as it arrives. At most 
+        sam_mesh.stream_max_views views are in flight and only their face2label tables are kept afterwards.
+        """
+        max_views = self.config.sam_mesh.get('stream_max_views', 4)
+        print('Computing face2label for each view with at most ', max_views, ' views in flight')
+        num_faces = len(self.renderer.tmesh.faces)
+        label_sequence_count = 1 # background is 0
+        face2label_views = []
+        pending = deque()
+        for item in renders:
+            labels = np.unique(item['cmasks'])
+            labels = labels[labels != 0] # remove background
+            pending.append(self.pool.apply_async(compute_face2label, (
+                labels, item['faces'], item['cmasks'], item['norms'], item['poses'], 
+                label_sequence_count, self.config.sam_mesh.get('face2label_threshold', 16), num_faces
+            )))
+            label_sequence_count += len(labels)
+            del item
+            while len(pending) >= max_views:
+                face2label_views.append(pending.popleft().get())
+        face2label_views.extend(result.get() for result in pending)
+        self.cache_save('face2label', lambda path: save_face2label_views(face2label_views, path))
+        return self.lift_views(face2label_views)
+
+    def lift_views(self, face2label_views: list[sparse.coo_matrix]) -> dict:
+        """
+        Merges per view face2label tables into consistent labels through the match graph.
+        """
+        num_faces = len(self.renderer.tmesh.faces)
+        label_sequence_count = max(face2label.shape[1] for face2label in face2label_views)
+
+        print('Building match graph')
+        face2label_views = [compute_face2label_majority(face2label) for face2label in face2label_views]
+        connections, connected = compute_connections(
+            face2label_views, label_sequence_count, self.config.sam_mesh.get('connections_threshold', 32)
+        )
+
         # normalize ratios
-        for label1, counter in connections_ratios.items():
-            total = sum(counter.values())
-            connections_ratios[label1] = {k: v / total for k, v in counter.items()}
+        connections_ratios = connections.astype(float)
+        connections_ratios.data /= np.repeat(np.asarray(connections.sum(axis=1)).reshape(-1), np.diff(connections.indptr))
 
-        counter_lens = [len(counter) for counter in connections_ratios.values()]
-        counter_lens = sorted(counter_lens)
-        counter_lens_threshold = max(np.percentile(counter_lens, 95), self.config.sam_mesh.get('counter_lens_threshold_min', 16))
+        counter_lens = connections_ratios.getnnz(axis=1)
+        counter_lens_threshold = max(np.percentile(counter_lens[connected], 95), self.config.sam_mesh.get('counter_lens_threshold_min', 16))
         print('Counter lens threshold: ', counter_lens_threshold)
-        removed = []
-        for label, counter in connections_ratios.items():
-            if len(counter) > counter_lens_threshold:
-                removed.append(label)
-        for label in removed:
-            connections_ratios.pop(label)
-            for counter in connections_ratios.values():
-                if label in counter:
-                    counter.pop(label)
-
-        '''
-        print('Count ratios:')
-        for label1, counter in connections_ratios.items():
-            print(label1)
-            for label2, count in counter.items():
-                print(label2, count)
-        exit()
-        '''
+        keep = counter_lens <= counter_lens_threshold
+        connections_ratios = connections_ratios.tocoo()
+        select = keep[connections_ratios.row] & keep[connections_ratios.col]
+        connections_ratios = sparse.csr_matrix((
+            connections_ratios.data[select], (connections_ratios.row[select], connections_ratios.col[select])
+        ), shape=connections_ratios.shape)
 
         bins_resolution = self.config.sam_mesh.connections_bin_resolution
-        bins = np.zeros(bins_resolution + 1)
-        for label1, counter in connections_ratios.items():
-            #print(label1)
-            for label2, ratio in counter.items():
-                #print(label2, ratio)
-                bins[int(ratio * bins_resolution)] += 1
+        bins = np.bincount((connections_ratios.data * bins_resolution).astype(int), minlength=bins_resolution + 1)
         cutoff = self.config.sam_mesh.connections_bin_threshold_percentage * np.sum(bins) # more connections means higher threshold
         accum = 0
         accum_bin = 0
@@ -432,16 +816,12 @@ class SamModelMesh(nn.Module):
         '''
 
         # construct match graph edges
-        connections = []
         connections_ratio_threshold = max(accum_bin / bins_resolution, 0.075)
         print('Connections ratio threshold: ', connections_ratio_threshold)
-        for label1, counter in connections_ratios.items():
-            for label2, ratio12 in counter.items():
-                ratio21 = connections_ratios[label2][label1]
-                # best buddy match above threshold
-                if ratio12 > connections_ratio_threshold and \
-                   ratio21 > connections_ratio_threshold:
-                    connections.append((label1, label2))
+        # best buddy match above threshold
+        connections_above = connections_ratios > connections_ratio_threshold
+        connections_above = connections_above.multiply(connections_above.T).tocoo()
+        connections = list(zip(connections_above.row.tolist(), connections_above.col.tolist()))
         print('Found ', len(connections), ' connections')
     
         connection_graph = igraph.Graph(edges=connections, directed=False)
@@ -459,121 +839,102 @@ class SamModelMesh(nn.Module):
         print('Found ', comm_count, ' communities')
 
         print('Merging labels')
-        face2label_combined = defaultdict(Counter)
+        # faces take the majority label of the last view that labels them
+        face2label_combined = np.full(num_faces, UNLABELED, dtype=np.int32)
         for face2label in face2label_views:
-            face2label_combined.update(face2label)
-        face2label_consistent = {}
-        for face, labels in face2label_combined.items():
-            hook = labels.most_common(1)[0][0]
-            if hook in label2label_consistent:
-                hook = label2label_consistent[hook]
-            face2label_consistent[face] = hook
+            face2label_combined = np.where(face2label != UNLABELED, face2label, face2label_combined)
+        hooks = np.arange(label_sequence_count, dtype=np.int32)
+        for label, hook in label2label_consistent.items():
+            hooks[label] = hook
+        face2label_consistent = np.where(face2label_combined != UNLABELED, hooks[face2label_combined], UNLABELED).astype(np.int32)
+        if self.config.sam_mesh.get('repartition_soft', False):
+            self.face2label_likelihoods = compute_face2label_likelihoods(face2label_views, hooks, label_sequence_count)
         #print(sorted(face2label_consistent.values()))
         return face2label_consistent
 
-    def smooth(self, face2label_consistent: dict) -> dict:
+    def smooth(self, face2label_consistent: NumpyTensor['f']) -> NumpyTensor['f']:
         """
         """
+        face2label_consistent = face2label_consistent.copy()
+
         # remove holes
-        components = self.label_components(face2label_consistent)
+        components, components_size, components_area = self.label_components(face2label_consistent)
 
         threshold_percentage_size = self.config.sam_mesh.smoothing_threshold_percentage_size
         threshold_percentage_area = self.config.sam_mesh.smoothing_threshold_percentage_area
-        components = sorted(components, key=lambda x: len(x), reverse=True)
-        components_area = [
-            sum([float(self.renderer.tmesh.area_faces[face]) for face in comp]) for comp in components
-        ]
-        max_size = max([len(comp) for comp in components])
-        max_area = max(components_area)
-
-        remove_comp_size = set()
-        remove_comp_area = set()
-        for i, comp in enumerate(components):
-            if len(comp)          < max_size * threshold_percentage_size:
-                remove_comp_size.add(i)
-            if components_area[i] < max_area * threshold_percentage_area:
-                remove_comp_area.add(i)
-        remove_comp = remove_comp_size.intersection(remove_comp_area)
-        print('Removing ', len(remove_comp), ' components')
-        for i in remove_comp:
-            for face in components[i]:
-                face2label_consistent.pop(face)
+        remove_comp = \
+            (components_size < components_size.max() * threshold_percentage_size) & \
+            (components_area < components_area.max() * threshold_percentage_area)
+        print('Removing ', remove_comp.sum(), ' components')
+        labeled = components != -1
+        face2label_consistent[np.flatnonzero(labeled)[remove_comp[components[labeled]]]] = UNLABELED
         
-        # fill islands
+        # fill islands by majority vote of labeled neighbors, ties broken by neighbor order, until nothing changes
         print('Smoothing labels')
         smooth_iterations = self.config.sam_mesh.smoothing_iterations
         for iteration in range(smooth_iterations):
-            count = 0
-            changes = {}
-            for face in range(len(self.renderer.tmesh.faces)):
-                if face in face2label_consistent:
-                    continue
-                labels_adj = Counter()
-                for adj in self.mesh_graph[face]:
-                    if adj in face2label_consistent:
-                        label = face2label_consistent[adj]
-                        if label != 0:
-                            labels_adj[label] += 1
-                if len(labels_adj):
-                    count += 1
-                    changes[face] = labels_adj.most_common(1)[0][0]
-            for face, label in changes.items():
-                face2label_consistent[face] = label
-            #print('Smoothing iteration ', iteration, ' changed ', count, ' faces')
+            unlabeled = face2label_consistent == UNLABELED
+            labels_adj, counts_adj = self.mesh_graph.vote(
+                face2label_consistent, valid=~unlabeled & (face2label_consistent != 0), faces=unlabeled
+            )
+            changes = unlabeled & (counts_adj > 0)
+            #print('Smoothing iteration ', iteration, ' changed ', changes.sum(), ' faces')
+            if not changes.any():
+                break
+            face2label_consistent[changes] = labels_adj[changes]
 
         return face2label_consistent
 
-    def split(self, face2label_consistent: dict) -> dict:
+    def split(self, face2label_consistent: NumpyTensor['f']) -> NumpyTensor['f']:
         """
         """
-        components = self.label_components(face2label_consistent)
-
-        labels_seen = set()
-        labels_curr = max(face2label_consistent.values()) + 1
-        labels_orig = labels_curr
-        for comp in components:
-            face = comp.pop()
-            label = face2label_consistent[face]
-            comp.add(face)
-            if label == 0 or label in labels_seen: # background or repeated label
-                face2label_consistent.update({face: labels_curr for face in comp})
-                labels_curr += 1
-            labels_seen.add(label)
-        print('Split', (labels_curr - labels_orig), 'times') # account for background
+        face2label_consistent = face2label_consistent.copy()
+        components, components_size, _ = self.label_components(face2label_consistent)
+        labeled = components != -1
+
+        # first component (by smallest face) of each label keeps it, background and repeated labels get new labels
+        components_label = np.zeros(len(components_size), dtype=face2label_consistent.dtype)
+        components_label[components[labeled]] = face2label_consistent[labeled]
+        _, first = np.unique(components_label, return_index=True)
+        relabel = np.ones(len(components_size), dtype=bool)
+        relabel[first] = False
+        relabel |= components_label == 0
+        labels_orig = int(face2label_consistent.max()) + 1
+        components_label[relabel] = labels_orig + np.arange(relabel.sum())
+        face2label_consistent[labeled] = components_label[components[labeled]]
+        print('Split', relabel.sum(), 'times') # account for background
 
         return face2label_consistent
 
-    def smooth_repartition_faces(self, face2label_consistent: dict, target_labels=None) -> dict:
+    def smooth_repartition_faces(
+        self, face2label_consistent: NumpyTensor['f'], target_labels=None, likelihoods: sparse.spmatrix=None
+    ) -> NumpyTensor['f']:
         """
+        Pass likelihoods, e.g. vote fractions from lift, to use them as data cost instead of the labels themselves.
         """
         tmesh = self.renderer.tmesh
 
-        partition = np.array([face2label_consistent[face] for face in range(len(tmesh.faces))])
+        partition = face2label_consistent.astype(int) # copy since repartition operates in place
 
-        cost_data = np.zeros((len(tmesh.faces), np.max(partition) + 1))
-        for f in range(len(tmesh.faces)):
-            for l in np.unique(partition):
-                cost_data[f, l] = 0 if partition[f] == l else 1
+        cost_data = compute_cost_data(partition, likelihoods)
         cost_smoothness = -np.log(tmesh.face_adjacency_angles / np.pi + 1e-20)
         
         lambda_seed = self.config.sam_mesh.repartition_lambda
+        # optionally only solve near label boundaries
+        band_kwargs = {
+            'band_rings'       : self.config.sam_mesh.get('repartition_band_rings', None),
+            'band_max_fraction': self.config.sam_mesh.get('repartition_band_max_fraction', 0.5),
+        }
         if target_labels is None:
-            refined_partition = repartition(tmesh, partition, cost_data, cost_smoothness, self.config.sam_mesh.repartition_iterations, lambda_seed)
-            return {
-                face: refined_partition[face] for face in range(len(tmesh.faces))
-            }
+            return repartition(
+                tmesh, partition, cost_data, cost_smoothness, self.config.sam_mesh.repartition_iterations, lambda_seed, **band_kwargs
+            )
     
         lambda_range=(
             self.config.sam_mesh.repartition_lambda_lb, 
             self.config.sam_mesh.repartition_lambda_ub
         )
         lambdas = np.linspace(*lambda_range, num=mp.cpu_count())
-        chunks = [
-            (tmesh, partition, cost_data, cost_smoothness, self.config.sam_mesh.repartition_iterations, _lambda) 
-            for _lambda in lambdas
-        ]
-        with mp.Pool(mp.cpu_count() // 2) as pool:
-            refined_partitions = pool.starmap(repartition, chunks)
 
         def compute_cur_labels(part, noise_threshold=10):
             """
@@ -582,92 +943,190 @@ class SamModelMesh(nn.Module):
             return values[counts > noise_threshold]
 
         # lambda crawling algorithm when target_labels is specified i.e. Princeton Mesh Segmentation Benchmark
-        max_iteration = 8
-        cur_iteration = 0
-        cur_lambda_index = np.searchsorted(lambdas, lambda_seed)
-        cur_labels = len(compute_cur_labels(refined_partitions[cur_lambda_index]))
-        while not (
-            target_labels - self.config.sam_mesh.repartition_lambda_tolerance <= cur_labels and
-            target_labels + self.config.sam_mesh.repartition_lambda_tolerance >= cur_labels
-        ) and cur_iteration < max_iteration:
-            
-            if cur_labels < target_labels and cur_lambda_index > 0:
-                # want more labels so decrease lambda
-                cur_lambda_index -= 1
-            if cur_labels > target_labels and cur_lambda_index < len(refined_partitions) - 1:
-                # want less labels so increase lambda
-                cur_lambda_index += 1
-
-            cur_labels = len(compute_cur_labels(refined_partitions[cur_lambda_index]))
-            cur_iteration += 1
-
-        print('Repartitioned with ', cur_labels, ' labels aiming for ', target_labels, 'target labels using lambda ', lambdas[cur_lambda_index], ' in ', cur_iteration, ' iterations')
+        # partitions are computed on demand and memoized, prefetching the lambdas the crawl can move to next
+        shared = SharedArrays({
+            'face_adjacency' : tmesh.face_adjacency,
+            'partition'      : partition,
+            'cost_data'      : cost_data,
+            'cost_smoothness': cost_smoothness,
+        })
+        refined_partitions = {}
+
+        def request(index: int):
+            if 0 <= index < len(lambdas) and index not in refined_partitions:
+                refined_partitions[index] = self.pool.apply_async(
+                    repartition_shared, (shared.descriptors, self.config.sam_mesh.repartition_iterations, lambdas[index]), band_kwargs
+                )
+
+        def refined_partition(index: int) -> NumpyTensor['f']:
+            for i in [index, index - 1, index + 1]:
+                request(i)
+            return refined_partitions[index].get()
+
+        try:
+            max_iteration = 8
+            cur_iteration = 0
+            cur_lambda_index = np.searchsorted(lambdas, lambda_seed)
+            cur_labels = len(compute_cur_labels(refined_partition(cur_lambda_index)))
+            while not (
+                target_labels - self.config.sam_mesh.repartition_lambda_tolerance <= cur_labels and
+                target_labels + self.config.sam_mesh.repartition_lambda_tolerance >= cur_labels
+            ) and cur_iteration < max_iteration:
+                
+                if cur_labels < target_labels and cur_lambda_index > 0:
+                    # want more labels so decrease lambda
+                    cur_lambda_index -= 1
+                if cur_labels > target_labels and cur_lambda_index < len(lambdas) - 1:
+                    # want less labels so increase lambda
+                    cur_lambda_index += 1
+
+                cur_labels = len(compute_cur_labels(refined_partition(cur_lambda_index)))
+                cur_iteration += 1
+            partition = refined_partitions[cur_lambda_index].get()
+        finally:
+            # prefetches the crawl discarded are not waited on: unlinking keeps the buffers of workers already attached
+            # mapped until they finish, and prefetches still queued fail to attach and return at once
+            shared.close()
+
+        print('Repartitioned with ', cur_labels, ' labels aiming for ', target_labels, 'target labels using lambda ', lambdas[cur_lambda_index], ' in ', cur_iteration, ' iterations', ' evaluating ', len(refined_partitions), ' lambdas')
         
-        refined_partition = refined_partitions[cur_lambda_index]
-        return {
-            face: refined_partition[face] for face in range(len(tmesh.faces))
-        }
+        return partition
 
-    def forward(self, scene: Scene, visualize_path=None, target_labels=None) -> tuple[dict, Trimesh]:
+    def forward(self, scene: Scene, visualize_path=None, target_labels=None, coarse=True) -> tuple[NumpyTensor['f'], Trimesh]:
         """
+        Meshes with more than sam_mesh.coarse_faces faces are segmented coarse to fine unless coarse is False.
         """
+        coarse_faces = self.config.sam_mesh.get('coarse_faces', None)
+        if coarse and coarse_faces is not None:
+            tmesh = scene2mesh(scene) if isinstance(scene, Scene) else scene
+            if len(tmesh.faces) > coarse_faces:
+                return self.forward_coarse(tmesh, visualize_path=visualize_path, target_labels=target_labels)
+
         self.load(scene)
-        renders = self.render(scene, visualize_path=visualize_path)
-        face2label_consistent = self.lift(renders)
-        face2label_consistent = self.smooth(face2label_consistent)
-        # inject unlabeled faces after smoothing
-        for face in range(len(self.renderer.tmesh.faces)):
-            if face not in face2label_consistent:
-                face2label_consistent[face] = 0
-        face2label_consistent = self.split (face2label_consistent) # needed to label all faces for repartition
-        face2label_consistent = self.smooth_repartition_faces(face2label_consistent, target_labels=target_labels)
-        face2label_consistent = {int(k): int(v) for k, v in face2label_consistent.items()} # ensure serialization
+
+        def lift() -> dict:
+            self.face2label_likelihoods = None
+            path = self.cache_lookup('face2label')
+            if path is not None: # renders and masks are not needed
+                face2label_consistent = self.lift_views(load_face2label_views(path))
+            elif self.config.sam_mesh.get('stream', False):
+                with closing(self.render_stream(scene, visualize_path=visualize_path)) as renders:
+                    face2label_consistent = self.lift_stream(renders)
+            else:
+                renders = self.render(scene, visualize_path=visualize_path)
+                face2label_consistent = self.lift(renders)
+            return {'face2label': face2label_consistent, 'likelihoods': self.face2label_likelihoods}
+
+        def smooth() -> dict:
+            outputs = self.checkpoint('lift', lift)
+            face2label_consistent = self.smooth(outputs['face2label'])
+            # inject unlabeled faces after smoothing
+            face2label_consistent[face2label_consistent == UNLABELED] = 0
+            return {'face2label': face2label_consistent, 'likelihoods': outputs['likelihoods']}
+
+        def split() -> dict:
+            outputs = self.checkpoint('smooth', smooth)
+            face2label_smoothed   = outputs['face2label']
+            face2label_consistent = self.split(face2label_smoothed) # needed to label all faces for repartition
+            likelihoods = None
+            if outputs['likelihoods'] is not None:
+                likelihoods = relabel_likelihoods(outputs['likelihoods'], face2label_smoothed, face2label_consistent)
+            return {'face2label': face2label_consistent, 'likelihoods': likelihoods}
+
+        # stages resume from the latest checkpoint in the cache, if any
+        outputs = self.checkpoint('split', split)
+        face2label_consistent = self.smooth_repartition_faces(
+            outputs['face2label'], target_labels=target_labels, likelihoods=outputs['likelihoods']
+        )
+        face2label_consistent = face2label_consistent.astype(np.int32)
         assert self.renderer.tmesh.faces.shape[0] == len(face2label_consistent)
         return face2label_consistent, self.renderer.tmesh
 
-    def label_components(self, face2label: dict) -> list[set]:
+    def forward_coarse(self, tmesh: Trimesh, visualize_path=None, target_labels=None) -> tuple[NumpyTensor['f'], Trimesh]:
         """
-        """
-        components = []
-        visited = set()
-
-        def dfs(source: int):
-            stack = [source]
-            components.append({source})
-            visited.add(source)
-            
-            while stack:
-                node = stack.pop()
-                for adj in self.mesh_graph[node]:
-                    if adj not in visited and adj in face2label and face2label[adj] == face2label[node]:
-                        stack.append(adj)
-                        components[-1].add(adj)
-                        visited.add(adj)
+        Segments a proxy of tmesh decimated to sam_mesh.coarse_faces faces, transfers its labels to tmesh by nearest face and
+        refines them near label boundaries at full resolution.
 
-        for face in range(len(self.renderer.tmesh.faces)):
-            if face not in visited and face in face2label:
-                dfs(face)
-        return components
+        NOTE:: the proxy is rendered without visuals.
+        """
+        print('Segmenting proxy with ', self.config.sam_mesh.coarse_faces, ' of ', len(tmesh.faces), ' faces')
+        proxy = decimate_mesh(tmesh, self.config.sam_mesh.coarse_faces)
+        face2label_proxy, proxy = self.forward(proxy, visualize_path=visualize_path, target_labels=target_labels, coarse=False)
+        face2label = transfer_face_labels(proxy, face2label_proxy, tmesh)
+        face2label = self.refine_boundaries(tmesh, face2label)
+        return face2label.astype(np.int32), tmesh
+
+    def refine_boundaries(self, tmesh: Trimesh, face2label: NumpyTensor['f']) -> NumpyTensor['f']:
+        """
+        Repartitions faces within sam_mesh.coarse_refine_rings of label boundaries, solving only over those faces and the
+        ring around them, which is kept fixed.
+        """
+        rings = self.config.sam_mesh.get('coarse_refine_rings', 2)
+        edges = tmesh.face_adjacency
+        band   = boundary_band(edges, face2label, rings)
+        region = boundary_band(edges, face2label, rings + 1)
+        faces  = np.flatnonzero(region)
+        print('Refining ', band.sum(), ' boundary faces at full resolution')
+        if not band.any():
+            return face2label
+
+        index = np.full(len(face2label), -1)
+        index[faces] = np.arange(len(faces))
+        inner = region[edges[:, 0]] & region[edges[:, 1]]
+        labels, partition = np.unique(face2label[faces], return_inverse=True)
+        cost_data = compute_cost_data(partition)
+        fixed = ~band[faces]
+        cost_data[fixed] = np.inf
+        cost_data[fixed, partition[fixed]] = 0
+        cost_smoothness = -np.log(tmesh.face_adjacency_angles[inner] / np.pi + 1e-20)
+        partition = repartition(
+            index[edges[inner]], partition, cost_data, cost_smoothness,
+            self.config.sam_mesh.repartition_iterations,
+            self.config.sam_mesh.repartition_lambda
+        )
+        face2label = face2label.copy()
+        face2label[faces] = labels[partition]
+        return face2label
+
+    def label_components(self, face2label: NumpyTensor['f']) -> tuple[
+        NumpyTensor['f'],
+        NumpyTensor['c'],
+        NumpyTensor['c']
+    ]:
+        """
+        Connected components of faces sharing the same label, ignoring unlabeled faces, with their sizes and areas.
+        """
+        return label_components(
+            self.mesh_graph, face2label, valid=face2label != UNLABELED, area_faces=self.renderer.tmesh.area_faces
+        )
 
 
-def segment_mesh(filename: Path | str, config: OmegaConf, visualize=False, extension='glb', target_labels=None, texture=False) -> Trimesh:
+def segment_mesh(
+    filename: Path | str, config: OmegaConf, visualize=False, extension='glb', target_labels=None, texture=False, model: SamModelMesh=None
+) -> Trimesh:
     """
+    Pass model to reuse its SAM weights, renderer and worker pool when segmenting a batch of meshes. Otherwise a model is
+    created and closed once the mesh is segmented.
     """
     print('Segmenting mesh with SAMesh: ', filename)
     filename = Path(filename)
     config = copy.deepcopy(config)
-    config.cache  = Path(config.cache)  / filename.stem if "cache" in config else None
+    config.cache  = Path(config.cache) if "cache" in config else None # content addressed, shared by all meshes
     config.output = Path(config.output) / filename.stem
 
-    model = SamModelMesh(config)
     tmesh = read_mesh(filename, norm=True)
     if not texture:
         tmesh = remove_texture(tmesh, visual_kind='vertex')
     
     # run sam grounded mesh and optionally visualize renders
     visualize_path = f'{config.output}/{filename.stem}_visualized' if visualize else None
-    faces2label, _ = model(tmesh, visualize_path=visualize_path, target_labels=target_labels)
-    # print(type(faces2label)) # face2label은 dict. json 파일로 제공되는 것과 내용이 같음.
+    if model is None:
+        with SamModelMesh(config) as model:
+            faces2label, _ = model(tmesh, visualize_path=visualize_path, target_labels=target_labels)
+    else:
+        model.config = config
+        faces2label, _ = model(tmesh, visualize_path=visualize_path, target_labels=target_labels)
+    # print(type(faces2label)) # face2label은 면 순서의 레이블 배열. json 파일에서는 dict로 저장됨.
     # print(faces2label)
     
     ##### ys exp #####
@@ -682,6 +1141,7 @@ def segment_mesh(filename: Path | str, config: OmegaConf, visualize=False, exten
     os.makedirs(config.output, exist_ok=True)
     tmesh_colored = colormap_faces_mesh(tmesh, faces2label)
     tmesh_colored.export       (f'{config.output}/{filename.stem}_segmented.{extension}')
+    faces2label = {int(face): int(label) for face, label in enumerate(faces2label)} # ensure serialization
     json.dump(faces2label, open(f'{config.output}/{filename.stem}_face2label.json', 'w'))
     return tmesh_colored
 
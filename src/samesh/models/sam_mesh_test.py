@@ -0,0 +1,449 @@
+import tempfile
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pytest
+import trimesh
+from omegaconf import OmegaConf
+from PIL import Image
+from scipy import sparse
+
+from samesh.models import sam_mesh
+from samesh.models.sam_mesh import (
+    compute_face2label, compute_face2label_majority, compute_connections, compute_face2label_likelihoods, relabel_likelihoods,
+    compute_cost_data, compute_cache_keys, load_checkpoint, save_checkpoint, load_face2label_views, save_face2label_views, save_items, SamModelMesh,
+    segment_mesh
+)
+from samesh.models.shape_diameter_function import repartition, boundary_band
+from samesh.utils.masks import PackedMasks
+
+
+class StubRenderer:
+    """
+    Holds the object set by SamModelMesh.load without creating a GL context.
+    """
+    def __init__(self, config):
+        self.tmesh = None
+
+    def set_object(self, source, smooth=False):
+        self.tmesh = source
+
+    def set_camera(self, camera_params=None):
+        pass
+
+
+def create_model(monkeypatch, cache=None, **settings) -> SamModelMesh:
+    """
+    SamModelMesh with a stub renderer and without SAM, so only cached renders and masks can be used.
+    """
+    monkeypatch.setattr(sam_mesh, 'Renderer', StubRenderer)
+    config = OmegaConf.create({
+        'cache'   : cache,
+        'renderer': {'target_dim': [8, 8]},
+        'sam'     : {},
+        'sam_mesh': {'use_modes': ['matte'], 'num_workers': 2, **settings},
+    })
+    return SamModelMesh(config, device='cpu', use_sam=False)
+
+
+def cache_renders(model: SamModelMesh, tmesh: trimesh.Trimesh, num_views=4, size=32):
+    """
+    Loads tmesh and caches views of random faces, whose matte shades faces by face index modulo 3.
+    """
+    rng = np.random.default_rng(0)
+    faces = rng.integers(-1, len(tmesh.faces), (num_views, size, size)).astype(np.int32)
+    matte = np.where(faces[..., None] == -1, 255, 64 * (faces[..., None] % 3)).repeat(3, axis=-1).astype(np.uint8)
+    norms = np.zeros((num_views, size, size, 3))
+    norms[..., 2] = 1
+    model.load(tmesh)
+    path = model.cache.create('renders', model.cache_keys['renders'])
+    save_items({
+        'matte': [Image.fromarray(image) for image in matte], 'faces': faces, 'norms': norms, 'norms_masked': norms,
+        'poses': np.stack([np.eye(4)] * num_views),
+    }, path)
+    model.cache.commit('renders', model.cache_keys['renders'])
+
+
+def segment_by_value(images, masks):
+    """
+    Masks of each distinct value of the first channel of each image, standing in for SAM.
+    """
+    bmasks = []
+    for image in images:
+        image = np.asarray(image)[..., 0]
+        bmasks.append(PackedMasks.pack(image[None] == np.unique(image)[:, None, None]))
+    return bmasks
+
+
+def test_compute_face2label():
+    faceid = np.array([
+        [-1, 0, 0, 1],
+        [ 0, 0, 1, 1],
+        [ 2, 2, 1, 1],
+        [ 2, 2, 2, 3],
+    ])
+    mask = np.array([
+        [0, 1, 1, 2],
+        [1, 1, 2, 2],
+        [2, 2, 1, 2],
+        [2, 2, 1, 1],
+    ])
+    norms = np.zeros((4, 4, 3))
+    norms[..., 2] = 1
+    labels = np.array([1, 2])
+
+    face2label = compute_face2label(labels, faceid, mask, norms, np.eye(4), 5, threshold_counts=0, num_faces=4)
+    assert face2label.shape == (4, 7)
+    assert face2label.toarray()[:, 5:].tolist() == [
+        [4, 0],
+        [1, 4],
+        [1, 4],
+        [1, 0],
+    ]
+
+    face2label = compute_face2label(labels, faceid, mask, norms, np.eye(4), 5, threshold_counts=1, num_faces=4)
+    assert face2label.toarray()[:, 5:].tolist() == [
+        [4, 0],
+        [0, 4],
+        [0, 4],
+        [0, 0],
+    ]
+
+
+def test_compute_face2label_random():
+    rng = np.random.default_rng(0)
+    faceid = rng.integers(-1, 64, (128, 128))
+    mask   = rng.integers( 0,  8, (128, 128))
+    norms  = rng.normal(size=(128, 128, 3))
+    labels = np.arange(1, 8)
+
+    face2label = compute_face2label(labels, faceid, mask, norms, np.eye(4), 1, threshold_counts=4, num_faces=64)
+    valid = sam_mesh.norms_mask(norms, np.eye(4))
+    for j, label in enumerate(labels):
+        counts = Counter(faceid[(mask == label) & valid & (faceid != -1)].tolist())
+        expected = np.zeros(64, dtype=int)
+        for face, count in counts.items():
+            if count > 4:
+                expected[face] = count
+        assert np.array_equal(face2label.tocsc()[:, 1 + j].toarray().reshape(-1), expected)
+
+
+def test_compute_face2label_majority():
+    face2label = compute_face2label(
+        np.array([1, 2]),
+        np.array([[0, 0, 1, 1]]),
+        np.array([[1, 2, 2, 2]]),
+        np.ones((1, 4, 3)), np.eye(4), 3, threshold_counts=0, num_faces=3
+    )
+    assert compute_face2label_majority(face2label).tolist() == [3, 4, -1] # ties broken by smallest label
+
+
+def test_compute_connections():
+    face2label_views = [
+        np.array([ 1,  1,  1,  2,  2, -1]),
+        np.array([ 3,  3,  4,  4,  4,  4]),
+        np.array([-1,  5,  5,  5, -1, -1]),
+    ]
+    connections, connected = compute_connections(face2label_views, 6, counter_threshold=0)
+    assert np.array_equal(connections.toarray(), connections.toarray().T)
+    assert connections[1, 3] == 2 and connections[1, 4] == 1 and connections[2, 4] == 2
+    assert connections[1, 5] == 2 and connections[2, 5] == 1
+    assert connections[3, 5] == 1 and connections[4, 5] == 2
+    assert connections[1, 2] == 0 and connections[3, 4] == 0 # same view
+    assert connected.tolist() == [False, True, True, True, True, True]
+
+    connections, connected = compute_connections(face2label_views, 6, counter_threshold=1)
+    assert connections.nnz == 8
+    assert connected.tolist() == [False, True, True, True, True, True]
+
+
+def test_compute_face2label_likelihoods():
+    face2label_views = [
+        np.array([ 1,  1,  2, -1]),
+        np.array([ 3,  4,  4, -1]),
+    ]
+    hooks = np.array([0, 1, 2, 1, 4]) # label 3 merged into 1
+    likelihoods = compute_face2label_likelihoods(face2label_views, hooks, 5)
+    assert likelihoods.toarray().tolist() == [
+        [0, 1.0, 0,   0, 0  ],
+        [0, 0.5, 0,   0, 0.5],
+        [0, 0,   0.5, 0, 0.5],
+        [0, 0,   0,   0, 0  ],
+    ]
+
+    # split renames the second component of label 1 to 5
+    likelihoods = relabel_likelihoods(likelihoods, np.array([1, 1, 2, 0]), np.array([1, 5, 2, 6]))
+    assert likelihoods.shape == (4, 7)
+    assert likelihoods[1, 5] == 0.5 and likelihoods[1, 1] == 0 and likelihoods[1, 4] == 0.5
+
+
+def test_compute_cost_data():
+    partition = np.array([0, 2, 2, 3])
+    cost_data = compute_cost_data(partition)
+    for f in range(len(partition)):
+        for l in np.unique(partition):
+            assert cost_data[f, l] == (0 if partition[f] == l else 1)
+
+    likelihoods = np.array([
+        [0.5, 0, 0.5, 0, 0],
+        [0,   0, 0,   0, 0],
+        [0,   0, 0.2, 0, 0.8],
+        [0,   0, 0,   1, 0],
+    ])
+    cost_data = compute_cost_data(partition, likelihoods)
+    assert cost_data.shape == (4, 4)
+    assert cost_data[0].tolist() == [0.5, 1, 0.5, 1]
+    assert cost_data[1].tolist() == [1, 1, 0, 1] # no likelihoods
+    assert cost_data[2].tolist() == [1, 1, 0.8, 1]
+    assert np.array_equal(compute_cost_data(partition, sparse.coo_matrix(likelihoods)), cost_data)
+
+
+def test_checkpoint():
+    face2label = np.array([0, 3, -1, 2])
+    likelihoods = sparse.csr_matrix(np.array([[1, 0, 0, 0], [0, 0, 0.25, 0.75], [0, 0, 0, 0], [0, 0, 1, 0]]))
+    face2label_views = [
+        sparse.coo_matrix(([17, 20], ([0, 3], [1, 2])), shape=(4, 3)),
+        sparse.coo_matrix(([33], ([1], [4])), shape=(4, 5)),
+    ]
+    with tempfile.TemporaryDirectory() as path:
+        save_checkpoint({'face2label': face2label, 'likelihoods': likelihoods}, Path(path))
+        outputs = load_checkpoint(Path(path))
+        save_face2label_views(face2label_views, Path(path))
+        face2label_views_loaded = load_face2label_views(Path(path))
+    assert outputs['face2label'].dtype == np.int32
+    assert outputs['face2label'].tolist() == face2label.tolist()
+    assert np.allclose(outputs['likelihoods'].toarray(), likelihoods.toarray())
+    for loaded, view in zip(face2label_views_loaded, face2label_views):
+        assert loaded.shape == view.shape
+        assert np.array_equal(loaded.toarray(), view.toarray())
+
+
+def test_compute_cache_keys():
+    tmesh = trimesh.creation.icosphere(subdivisions=1)
+    config = OmegaConf.create({
+        'renderer': {'target_dim': [8, 8]},
+        'sam'     : {'sam': {'engine_config': {'points_per_side': 32}}},
+        'sam_mesh': {'use_modes': ['matte'], 'min_area': 1024, 'num_workers': 2},
+    })
+    stages = ['graph', 'renders', 'masks', 'face2label', 'lift', 'smooth', 'split']
+    keys = compute_cache_keys(tmesh, config)
+    assert list(keys) == stages
+    assert compute_cache_keys(tmesh.copy(), config.copy()) == keys
+
+    changes = [
+        ('renders'   , 'renderer.target_dim', [16, 16]),
+        ('masks'     , 'sam.sam.engine_config.points_per_side', 16),
+        ('masks'     , 'sam_mesh.adaptive_points', True),
+        ('face2label', 'sam_mesh.min_area', 512),
+        ('lift'      , 'sam_mesh.connections_threshold', 8),
+        ('smooth'    , 'sam_mesh.smoothing_iterations', 2),
+        (None        , 'sam_mesh.num_workers', 4), # does not affect outputs
+    ]
+    for first, key, value in changes:
+        changed = config.copy()
+        OmegaConf.update(changed, key, value)
+        changed_keys = compute_cache_keys(tmesh, changed)
+        index = stages.index(first) if first is not None else len(stages)
+        for stage in stages[:index]:
+            assert changed_keys[stage] == keys[stage], (key, stage)
+        for stage in stages[index:]:
+            assert changed_keys[stage] != keys[stage], (key, stage)
+
+    moved = tmesh.copy()
+    moved.vertices[0] += 0.01
+    assert all(compute_cache_keys(moved, config)[stage] != keys[stage] for stage in stages)
+
+
+def test_model_close(monkeypatch):
+    with create_model(monkeypatch) as model:
+        pool = model.pool
+        assert model.pool is pool
+    assert model._pool is None
+
+    models = []
+    def forward(self, tmesh, **kwargs):
+        models.append(self)
+        self.pool # started by lift and repartition
+        return np.zeros(len(tmesh.faces), dtype=np.int32), tmesh
+    monkeypatch.setattr(SamModelMesh, 'forward', forward)
+    with tempfile.TemporaryDirectory() as path:
+        filename = Path(path) / 'sphere.obj'
+        trimesh.creation.icosphere(subdivisions=1).export(filename)
+        config = create_model(monkeypatch).config
+        config.output = path
+        config.pop('cache') # cache disabled by omitting it, as in the configs
+        (Path(path) / 'sphere').mkdir() # submeshes are exported before the output directory is created
+        segment_mesh(filename, config)
+    assert len(models) == 1 and models[0]._pool is None # model created by segment_mesh is closed
+
+
+def test_lift_stream(monkeypatch):
+    settings = {
+        'min_area': 0, 'face2label_threshold': 0, 'connections_threshold': 0,
+        'connections_bin_resolution': 100, 'connections_bin_threshold_percentage': 0.125,
+    }
+    tmesh = trimesh.creation.icosphere(subdivisions=2)
+    outputs = []
+    for stream in [False, True]:
+        with tempfile.TemporaryDirectory() as path, create_model(monkeypatch, cache=path, **settings) as model:
+            cache_renders(model, tmesh)
+            model.call_sam_batch = segment_by_value
+            if stream:
+                face2label = model.lift_stream(model.render_stream(tmesh))
+            else:
+                face2label = model.lift(model.render(tmesh))
+            assert model.cache_lookup('masks') is not None
+            outputs.append((face2label, load_face2label_views(model.cache_lookup('face2label'))))
+
+    (face2label, face2label_views), (face2label_stream, face2label_views_stream) = outputs
+    assert len(np.unique(face2label)) > 1
+    assert np.array_equal(face2label, face2label_stream)
+    assert len(face2label_views) == len(face2label_views_stream) == 4
+    for view, view_stream in zip(face2label_views, face2label_views_stream):
+        assert view.shape == view_stream.shape
+        assert np.array_equal(view.toarray(), view_stream.toarray())
+
+
+def test_render_stream_interrupted(monkeypatch):
+    tmesh = trimesh.creation.icosphere(subdivisions=2)
+    with tempfile.TemporaryDirectory() as path, create_model(monkeypatch, cache=path, min_area=0) as model:
+        cache_renders(model, tmesh)
+        path_masks = model.cache.path('masks', model.cache_keys['masks'])
+
+        def call_sam_batch(images, masks):
+            if call_sam_batch.calls == 1:
+                raise RuntimeError('SAM failed')
+            call_sam_batch.calls += 1
+            return segment_by_value(images, masks)
+        call_sam_batch.calls = 0
+        model.call_sam_batch = call_sam_batch
+        with pytest.raises(RuntimeError):
+            list(model.render_stream(tmesh))
+        assert not path_masks.exists() # partial entry is removed
+
+        model.call_sam_batch = segment_by_value
+        renders = model.render_stream(tmesh)
+        next(renders)
+        renders.close() # consumer stops before the last view
+        assert not path_masks.exists()
+        assert model.cache_lookup('renders') is not None
+
+        assert len(list(model.render_stream(tmesh))) == 4
+        assert model.cache_lookup('masks') is not None
+
+
+def test_smooth_repartition_faces_crawl(monkeypatch):
+    tmesh = trimesh.creation.icosphere(subdivisions=3)
+    rng = np.random.default_rng(0)
+    partition = np.argmin(((tmesh.triangles_center[:, None] - rng.normal(size=(12, 3))[None]) ** 2).sum(-1), axis=1)
+    noise = rng.random(len(partition)) < 0.1
+    partition[noise] = rng.integers(0, 12, noise.sum())
+    settings = {
+        'repartition_lambda': 1.0, 'repartition_lambda_lb': 0.05, 'repartition_lambda_ub': 2.0,
+        'repartition_lambda_tolerance': 0, 'repartition_iterations': 1,
+    }
+    monkeypatch.setattr(sam_mesh.mp, 'cpu_count', lambda: 8) # number of lambdas
+
+    # baseline: repartition with every lambda, then crawl from the seed lambda
+    lambdas = np.linspace(settings['repartition_lambda_lb'], settings['repartition_lambda_ub'], num=8)
+    cost_data = compute_cost_data(partition)
+    cost_smoothness = -np.log(tmesh.face_adjacency_angles / np.pi + 1e-20)
+    partitions = [repartition(tmesh, partition.copy(), cost_data, cost_smoothness, 1, _lambda) for _lambda in lambdas]
+    num_labels = [int((np.unique(part, return_counts=True)[1] > 10).sum()) for part in partitions]
+    assert len(set(num_labels)) > 2
+
+    with create_model(monkeypatch, **settings) as model:
+        model.renderer.tmesh = tmesh
+        for target_labels in [num_labels[0], num_labels[-1], 4]: # crawl down, up and oscillating until max iterations
+            index = np.searchsorted(lambdas, settings['repartition_lambda'])
+            cur_labels = num_labels[index]
+            for _ in range(8):
+                if cur_labels == target_labels:
+                    break
+                if cur_labels < target_labels and index > 0:
+                    index -= 1
+                if cur_labels > target_labels and index < len(lambdas) - 1:
+                    index += 1
+                cur_labels = num_labels[index]
+            refined = model.smooth_repartition_faces(partition, target_labels=target_labels)
+            assert np.array_equal(refined, partitions[index])
+
+
+def test_forward_resume(monkeypatch):
+    tmesh = trimesh.creation.icosphere(subdivisions=2)
+    face2label = np.where(tmesh.triangles_center[:, 2] > 0, 1, 2).astype(np.int32)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('stage before the latest checkpoint was recomputed')
+
+    with tempfile.TemporaryDirectory() as path, create_model(monkeypatch, cache=path) as model:
+        model.load(tmesh)
+        model.cache_save('smooth', lambda path: save_checkpoint({'face2label': face2label, 'likelihoods': None}, path))
+        model.render = model.render_stream = model.lift = model.lift_views = model.smooth = fail
+        splits = []
+        split = model.split
+        model.split = lambda face2label: splits.append(face2label) or split(face2label)
+        model.smooth_repartition_faces = lambda face2label, target_labels=None, likelihoods=None: face2label
+
+        face2label_resumed, tmesh_out = model.forward(tmesh) # resumes from the smooth checkpoint
+        assert tmesh_out is tmesh and len(splits) == 1
+        assert np.array_equal(splits[0], face2label)
+        assert model.cache_lookup('split') is not None
+        assert np.array_equal(face2label_resumed[:, None] == face2label_resumed, face2label[:, None] == face2label)
+
+        model.split = fail
+        face2label_cached, _ = model.forward(tmesh) # resumes from the split checkpoint
+        assert np.array_equal(face2label_cached, face2label_resumed)
+
+
+def test_refine_boundaries(monkeypatch):
+    tmesh = trimesh.creation.icosphere(subdivisions=3)
+    rng = np.random.default_rng(0)
+    face2label = np.where(tmesh.triangles_center[:, 2] > 0, 3, 7).astype(np.int32)
+    noise = (np.abs(tmesh.triangles_center[:, 2]) < 0.15) & (rng.random(len(face2label)) < 0.3)
+    face2label[noise] = 10 - face2label[noise]
+
+    # lambda large enough to merge all labels if faces were not pinned
+    with create_model(monkeypatch, coarse_refine_rings=1, repartition_iterations=1, repartition_lambda=64) as model:
+        refined = model.refine_boundaries(tmesh, face2label)
+    band = boundary_band(tmesh, face2label, 1)
+    assert band.any() and not band.all()
+    assert np.array_equal(refined[~band], face2label[~band]) # pinned faces keep their labels
+    assert set(np.unique(refined)) == {3, 7}
+    boundary = lambda labels: (labels[tmesh.face_adjacency[:, 0]] != labels[tmesh.face_adjacency[:, 1]]).sum()
+    assert boundary(refined) < boundary(face2label)
+
+
+def test_forward_coarse(monkeypatch):
+    tmesh = trimesh.creation.icosphere(subdivisions=4)
+    proxies = []
+    def forward(proxy, visualize_path=None, target_labels=None, coarse=True):
+        assert not coarse
+        proxies.append(proxy)
+        return (proxy.triangles_center[:, 2] > 0).astype(np.int32), proxy
+
+    settings = {'coarse_faces': 320, 'coarse_refine_rings': 1, 'repartition_iterations': 1, 'repartition_lambda': 4}
+    with create_model(monkeypatch, **settings) as model:
+        model.forward_coarse = lambda tmesh, **kwargs: ('coarse', tmesh)
+        assert SamModelMesh.forward(model, tmesh) == ('coarse', tmesh) # dense meshes are segmented coarse to fine
+        del model.forward_coarse
+
+        model.forward = forward
+        face2label, tmesh_out = model.forward_coarse(tmesh)
+    assert tmesh_out is tmesh and len(proxies) == 1 and len(proxies[0].faces) <= 320
+    assert face2label.dtype == np.int32 and len(face2label) == len(tmesh.faces)
+    far = np.abs(tmesh.triangles_center[:, 2]) > 0.2 # away from the boundary between labels
+    assert np.array_equal(face2label[far], (tmesh.triangles_center[far, 2] > 0).astype(np.int32))
+
+
+if __name__ == "__main__":
+    test_compute_face2label()
+    test_compute_face2label_random()
+    test_compute_face2label_majority()
+    test_compute_connections()
+    test_compute_face2label_likelihoods()
+    test_compute_cost_data()
+    test_checkpoint()
+    test_compute_cache_keys()
+    print("All tests passed!")
@@ -0,0 +1,185 @@
+import inspect
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from samesh.models.sam import PREDICTOR_STATE, Sam2Model, remove_artifacts
+
+
+class StubPredictor:
+    """
+    Encodes images as their first channel and counts encoder calls.
+    """
+    def __init__(self):
+        self.num_encodes = 0
+        self.reset_predictor()
+
+    def set_image(self, image):
+        self.set_image_batch([image])
+        self._is_batch = False
+
+    def set_image_batch(self, images):
+        self.num_encodes += 1
+        self._features = {
+            'image_embed'   : torch.from_numpy(np.stack([image[..., 0] for image in images])),
+            'high_res_feats': [],
+        }
+        self._orig_hw = [image.shape[:2] for image in images]
+        self._is_image_set = True
+        self._is_batch = True
+
+    def reset_predictor(self):
+        self._features = None
+        self._orig_hw = None
+        self._is_image_set = False
+        self._is_batch = False
+
+
+class StubGenerator:
+    """
+    Generates one mask per point, of pixels brighter than the encoded image at the point.
+    """
+    crop_n_layers = 0
+
+    def __init__(self):
+        self.predictor = StubPredictor()
+        self.point_grids = None
+
+    def generate(self, image):
+        self.predictor.set_image(image)
+        assert self.predictor._is_image_set and not self.predictor._is_batch
+        embed = self.predictor._features['image_embed'][-1].numpy()
+        h, w = self.predictor._orig_hw[-1]
+        annotations = []
+        for x, y in self.point_grids[0]:
+            mask = embed > embed[int(y * (h - 1)), int(x * (w - 1))]
+            annotations.append({'segmentation': mask, 'area': int(mask.sum())})
+        self.predictor.reset_predictor()
+        return annotations
+
+
+class StubSam2Model(Sam2Model):
+    def setup_sam(self, mode='auto'):
+        self.engine = StubGenerator()
+
+
+def test_forward_batch():
+    config = OmegaConf.create({'sam': {'auto': True, 'ground': False, 'batch_size': 2}})
+    model = StubSam2Model(config, device='cpu')
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 255, (6, 8, 3), dtype=np.uint8) for _ in range(5)]
+    point_grids = [rng.uniform(size=(4, 2)) for _ in range(5)]
+
+    masks_batched = model.forward_batch(images, point_grids)
+    assert model.engine.predictor.num_encodes == 3 # ceil(5 / batch_size)
+    masks = []
+    for image, point_grid in zip(images, point_grids):
+        model.engine.point_grids = [point_grid]
+        masks.append(model.process_image(image))
+    assert len(masks_batched) == len(masks)
+    for mask_batched, mask in zip(masks_batched, masks):
+        assert np.array_equal(mask_batched.dense(), mask.dense())
+
+
+def test_forward_batch_refine():
+    config = OmegaConf.create({'sam': {'auto': True, 'ground': False, 'batch_size': 2}})
+    model = StubSam2Model(config, device='cpu')
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 255, (6, 8, 3), dtype=np.uint8) for _ in range(3)]
+    point_grids = [rng.uniform(size=(4, 2)) for _ in range(3)]
+    point_grids_refined = [rng.uniform(size=(2, 2)) for _ in range(3)]
+
+    calls = []
+    def refine(i, covered, num_rounds):
+        calls.append((i, covered.copy(), num_rounds))
+        return point_grids_refined[i] if num_rounds == 0 else None # one refinement round
+
+    masks_refined = model.forward_batch(images, point_grids, refine)
+    assert model.engine.predictor.num_encodes == 2 # refinement rounds reuse the encoded features
+    assert [(i, num_rounds) for i, _, num_rounds in calls] == [(0, 0), (0, 1), (1, 0), (1, 1), (2, 0), (2, 1)]
+    for i, image in enumerate(images):
+        model.engine.point_grids = [point_grids[i]]
+        assert np.array_equal(calls[2 * i][1], model.process_image(image).dense().any(axis=0))
+        model.engine.point_grids = [np.concatenate([point_grids[i], point_grids_refined[i]])]
+        assert np.array_equal(masks_refined[i].dense(), model.process_image(image).dense())
+
+
+def test_forward_batch_requires_auto():
+    model = StubSam2Model(OmegaConf.create({'sam': {'auto': False, 'ground': False}}), device='cpu')
+    with pytest.raises(ValueError):
+        model.forward_batch([np.zeros((6, 8, 3), dtype=np.uint8)], [np.full((1, 2), 0.5)])
+
+    model = StubSam2Model(OmegaConf.create({'sam': {'auto': True, 'ground': False}}), device='cpu')
+    del model.engine.predictor._is_batch
+    with pytest.raises(RuntimeError):
+        model.forward_batch([np.zeros((6, 8, 3), dtype=np.uint8)], [np.full((1, 2), 0.5)])
+
+
+def test_sam2_predictor_state():
+    pytest.importorskip('sam2') # forward_batch sets private predictor state, which generate sets through set_image
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+    from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+
+    predictor = SAM2ImagePredictor(SimpleNamespace(image_size=64))
+    for name in PREDICTOR_STATE:
+        assert hasattr(predictor, name), name
+    assert hasattr(predictor, 'set_image_batch') and hasattr(predictor, 'reset_predictor')
+    source = inspect.getsource(SAM2AutomaticMaskGenerator._process_crop)
+    assert 'self.predictor.set_image(' in source and 'self.predictor.reset_predictor()' in source
+
+
+def remove_artifacts_reference(mask, mode, min_area=128):
+    """
+    remove_artifacts processing every label over the whole mask.
+    """
+    mode_holes = (mode == 'holes')
+
+    def remove_helper(bmask):
+        bmask = (mode_holes ^ bmask).astype(np.uint8)
+        nregions, regions, stats, _ = cv2.connectedComponentsWithStats(bmask, 8)
+        sizes = stats[:, -1][1:]
+        fill = [i + 1 for i, s in enumerate(sizes) if s < min_area] + [0]
+        if not mode_holes:
+            fill = [i for i in range(nregions) if i not in fill]
+        return np.isin(regions, fill)
+
+    mask_combined = np.zeros_like(mask)
+    for label in np.unique(mask):
+        mask_combined[remove_helper(mask == label)] = label
+    return mask_combined
+
+
+def test_remove_artifacts():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        h, w = rng.integers(8, 48, size=2)
+        # blocks of labels, many touching the border, with speckles for islands and holes
+        blocks = rng.integers(0, 5, size=(h // 4 + 1, w // 4 + 1))
+        mask = np.kron(blocks, np.ones((4, 4), dtype=blocks.dtype))[:h, :w]
+        speckles = rng.random((h, w)) < 0.05
+        mask[speckles] = rng.integers(0, 7, size=speckles.sum())
+        mask[rng.integers(h), :] = 5 # labels spanning the mask
+        for mode in ['islands', 'holes']:
+            for min_area in [1, 4, 16, 64, 1024]:
+                assert np.array_equal(
+                    remove_artifacts(mask, mode, min_area), remove_artifacts_reference(mask, mode, min_area)
+                ), (mode, min_area)
+
+    mask = np.zeros((16, 16), dtype=int)
+    mask[4:12, 4:12] = 1
+    mask[7, 7] = 0 # hole
+    mask[15, 0] = 2 # island in the corner
+    assert remove_artifacts(mask, 'holes', 4)[7, 7] == 1
+    assert remove_artifacts(mask, 'islands', 4)[15, 0] == 0
+
+
+if __name__ == "__main__":
+    test_forward_batch()
+    test_forward_batch_refine()
+    test_forward_batch_requires_auto()
+    test_sam2_predictor_state()
+    test_remove_artifacts()
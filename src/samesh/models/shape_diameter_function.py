@@ -3,12 +3,10 @@ import json
 import os
 import copy
 from pathlib import Path
-from collections import defaultdict
 
 import numpy as np
 import pymeshlab
 import trimesh
-import networkx as nx
 import igraph
 from numpy.random import RandomState
 from trimesh.base import Trimesh, Scene
@@ -18,6 +16,7 @@ from omegaconf import OmegaConf
 
 from samesh.data.common import NumpyTensor
 from samesh.data.loaders import scene2mesh, read_mesh
+from samesh.utils.graph import FaceGraph, label_components
 from samesh.utils.mesh import duplicate_verts
 
 
@@ -25,124 +24,168 @@ EPSILON = 1e-20
 SCALE = 1e6
 
 
+def face_adjacency(mesh: Trimesh | NumpyTensor['e 2']) -> NumpyTensor['e 2']:
+    """
+    Repartition functions accept either a mesh or its face adjacency, which is all they need, so workers can share it.
+    """
+    return mesh.face_adjacency if isinstance(mesh, Trimesh) else mesh
+
+
 def partition_cost(
-    mesh           : Trimesh,
+    mesh           : Trimesh | NumpyTensor['e 2'],
     partition      : NumpyTensor['f'],
     cost_data      : NumpyTensor['f num_components'],
     cost_smoothness: NumpyTensor['e']
 ) -> float:
     """
     """
-    cost = 0
-    for f in range(len(partition)):
-        cost += cost_data[f, partition[f]]
-    for i, edge in enumerate(mesh.face_adjacency):
-        f1, f2 = int(edge[0]), int(edge[1])
-        if partition[f1] != partition[f2]:
-            cost += cost_smoothness[i]
-    return cost
+    edges = face_adjacency(mesh)
+    cost = cost_data[np.arange(len(partition)), partition].sum()
+    cost += cost_smoothness[partition[edges[:, 0]] != partition[edges[:, 1]]].sum()
+    return float(cost)
 
 
 def construct_expansion_graph(
     label          : int,
-    mesh           : Trimesh,
+    mesh           : Trimesh | NumpyTensor['e 2'],
     partition      : NumpyTensor['f'],
     cost_data      : NumpyTensor['f num_components'],
     cost_smoothness: NumpyTensor['e']
-) -> nx.Graph:
+) -> tuple[NumpyTensor['n 2'], NumpyTensor['n'], int]:
     """
+    Returns undirected edges, capacities and number of nodes of the alpha expansion graph, where node 0 is alpha, node 1
+    is alpha complement, nodes 2 to 2 + F are faces and the remaining nodes are auxillary nodes of edges between faces of
+    different labels.
     """
-    G = nx.Graph() # undirected graph
-    A = 'alpha'
-    B = 'alpha_complement'
-
-    node2index = {}
-    G.add_node(A)
-    G.add_node(B)
-    node2index[A] = 0
-    node2index[B] = 1
-    for i in range(len(mesh.faces)):
-        G.add_node(i)
-        node2index[i] = 2 + i
-
-    aux_count = 0
-    for i, edge in enumerate(mesh.face_adjacency): # auxillary nodes
-        f1, f2 = int(edge[0]), int(edge[1])
-        if partition[f1] != partition[f2]:
-            a = (f1, f2)
-            if a in node2index: # duplicate edge
-                continue
-            G.add_node(a)
-            node2index[a] = len(mesh.faces) + 2 + aux_count
-            aux_count += 1
-
-    for f in range(len(mesh.faces)):
-        G.add_edge(A, f, capacity=cost_data[f, label])
-        G.add_edge(B, f, capacity=float('inf') if partition[f] == label else cost_data[f, partition[f]])
-
-    for i, edge in enumerate(mesh.face_adjacency):
-        f1, f2 = int(edge[0]), int(edge[1])
-        a = (f1, f2)
-        if partition[f1] == partition[f2]:
-            if partition[f1] != label:
-                G.add_edge(f1, f2, capacity=cost_smoothness[i])
-        else:
-            G.add_edge(a, B, capacity=cost_smoothness[i])
-            if partition[f1] != label:
-                G.add_edge(f1, a, capacity=cost_smoothness[i])
-            if partition[f2] != label:
-                G.add_edge(a, f2, capacity=cost_smoothness[i])
-    
-    return G, node2index
+    edges = face_adjacency(mesh)
+    num_faces = len(partition)
+    faces = np.arange(num_faces)
+    f1, f2 = edges[:, 0], edges[:, 1]
+    same = partition[f1] == partition[f2]
+    diff = ~same
+    aux = num_faces + 2 + np.arange(diff.sum()) # auxillary nodes
+    f1_diff, f2_diff, cost_diff = f1[diff], f2[diff], cost_smoothness[diff]
+    f1_free = partition[f1_diff] != label
+    f2_free = partition[f2_diff] != label
+    keep = same & (partition[f1] != label)
+
+    alpha, alpha_complement = np.zeros(num_faces, dtype=int), np.ones(num_faces, dtype=int)
+    edges = np.concatenate([
+        np.stack([alpha, 2 + faces], axis=1),
+        np.stack([alpha_complement, 2 + faces], axis=1),
+        np.stack([2 + f1[keep], 2 + f2[keep]], axis=1),
+        np.stack([aux, np.ones(len(aux), dtype=int)], axis=1),
+        np.stack([2 + f1_diff[f1_free], aux[f1_free]], axis=1),
+        np.stack([aux[f2_free], 2 + f2_diff[f2_free]], axis=1),
+    ])
+    capacities = np.concatenate([
+        cost_data[:, label],
+        np.where(partition == label, np.inf, cost_data[faces, partition]),
+        cost_smoothness[keep],
+        cost_diff,
+        cost_diff[f1_free],
+        cost_diff[f2_free],
+    ])
+    return edges, capacities, num_faces + 2 + len(aux)
+
+
+def expansion_cut(
+    label          : int,
+    mesh           : Trimesh | NumpyTensor['e 2'],
+    partition      : NumpyTensor['f'],
+    cost_data      : NumpyTensor['f num_components'],
+    cost_smoothness: NumpyTensor['e']
+) -> NumpyTensor['f']:
+    """
+    Returns mask of faces assigned label by the minimum cut of the alpha expansion graph.
+    """
+    edges, capacities, num_nodes = construct_expansion_graph(label, mesh, partition, cost_data, cost_smoothness)
+
+    G = igraph.Graph(n=num_nodes, directed=False)
+    G.add_edges(edges) # faster than passing edges to the constructor
+    outputs = G.st_mincut(source=0, target=1, capacity=capacities.tolist())
+    S = np.zeros(num_nodes, dtype=bool)
+    S[outputs.partition[0]] = True
+    assert S[0] and not S[1]
+    S = S[2:len(partition) + 2]
+
+    assert (partition[S] == label).sum() == 0 # T consists of those assigned 'alpha' and S 'alpha_complement' (see paper)
+    return ~S
+
+
+def boundary_band(mesh: Trimesh | NumpyTensor['e 2'], partition: NumpyTensor['f'], rings: int) -> NumpyTensor['f']:
+    """
+    Returns mask of faces within rings of a face adjacent to a different label.
+    """
+    edges = face_adjacency(mesh)
+    band = np.zeros(len(partition), dtype=bool)
+    band[edges[partition[edges[:, 0]] != partition[edges[:, 1]]].reshape(-1)] = True
+    for _ in range(rings):
+        band[edges[band[edges[:, 0]] | band[edges[:, 1]]].reshape(-1)] = True
+    return band
 
 
 def repartition(
-    mesh: trimesh.Trimesh,
+    mesh: Trimesh | NumpyTensor['e 2'],
     partition      : NumpyTensor['f'],
     cost_data      : NumpyTensor['f num_components'],
     cost_smoothness: NumpyTensor['e'],
     smoothing_iterations: int,
     _lambda=1.0,
+    band_rings: int=None,
+    band_max_fraction=0.5,
 ):
-    A = 'alpha'
-    B = 'alpha_complement'
+    """
+    If band_rings is given, each iteration only solves for faces within band_rings of the label boundaries, with the
+    remaining faces fixed, unless the band covers more than band_max_fraction of the faces.
+    """
+    edges = face_adjacency(mesh)
     labels = np.unique(partition)
 
     cost_smoothness = cost_smoothness * _lambda
 
-    # networkx broken for float capacities
-    #cost_data       = np.round(cost_data       * SCALE).astype(int)
-    #cost_smoothness = np.round(cost_smoothness * SCALE).astype(int)
-
-    cost_min = partition_cost(mesh, partition, cost_data, cost_smoothness)
+    cost_min = partition_cost(edges, partition, cost_data, cost_smoothness)
 
     for i in range(smoothing_iterations):
 
         #print('Repartition iteration ', i)
+
+        band = boundary_band(edges, partition, band_rings) if band_rings is not None else None
+        if band is not None and band.sum() > band_max_fraction * len(partition):
+            band = None # fall back to full solve
+        if band is not None:
+            # band subproblem shared by all labels of this iteration, where edges to fixed faces become data costs
+            faces = np.flatnonzero(band)
+            index = np.full(len(partition), -1)
+            index[faces] = np.arange(len(faces))
+            inner = band[edges[:, 0]] & band[edges[:, 1]]
+            outer = band[edges[:, 0]] ^ band[edges[:, 1]]
+            edges_inner, cost_inner = index[edges[inner]], cost_smoothness[inner]
+            outer_band  = np.where(band[edges[outer, 0]], edges[outer, 0], edges[outer, 1])
+            outer_fixed = np.where(band[edges[outer, 0]], edges[outer, 1], edges[outer, 0])
+            outer_band, outer_labels, cost_outer = index[outer_band], partition[outer_fixed], cost_smoothness[outer]
+            cost_data_band = cost_data[faces]
         
         for label in tqdm(labels):
-            G, node2index = construct_expansion_graph(label, mesh, partition, cost_data, cost_smoothness)
-            index2node = {v: k for k, v in node2index.items()}
-
-            '''
-            _, (S, T) = nx.minimum_cut(G, A, B)
-            assert A in S and B in T
-            S = np.array([v for v in S if isinstance(v, int)]).astype(int)
-            T = np.array([v for v in T if isinstance(v, int)]).astype(int)
-            '''
-
-            G = igraph.Graph.from_networkx(G)
-            outputs = G.st_mincut(source=node2index[A], target=node2index[B], capacity='capacity')
-            S = outputs.partition[0]
-            T = outputs.partition[1]
-            assert node2index[A] in S and node2index[B] in T
-            S = np.array([index2node[v] for v in S if isinstance(index2node[v], int)]).astype(int)
-            T = np.array([index2node[v] for v in T if isinstance(index2node[v], int)]).astype(int)
-
-            assert (partition[S] == label).sum() == 0 # T consists of those assigned 'alpha' and S 'alpha_complement' (see paper)
-            partition[T] = label
-
-            cost = partition_cost(mesh, partition, cost_data, cost_smoothness)
+            if band is None:
+                partition[expansion_cut(label, edges, partition, cost_data, cost_smoothness)] = label
+            else:
+                partition_band = partition[faces]
+                cost_alpha = np.bincount(outer_band, weights=cost_outer * (outer_labels != label), minlength=len(faces))
+                cost_keep  = np.bincount(
+                    outer_band, weights=cost_outer * (outer_labels != partition_band[outer_band]), minlength=len(faces)
+                )
+                keep = np.flatnonzero(partition_band != label) # cost of keeping label is infinite otherwise
+                cost_data_alpha = cost_data_band[:, label].copy()
+                cost_data_keep  = cost_data_band[keep, partition_band[keep]].copy()
+                cost_data_band[:, label] += cost_alpha
+                cost_data_band[keep, partition_band[keep]] += cost_keep[keep]
+                assign = expansion_cut(label, edges_inner, partition_band, cost_data_band, cost_inner)
+                cost_data_band[:, label] = cost_data_alpha
+                cost_data_band[keep, partition_band[keep]] = cost_data_keep
+                partition[faces[assign]] = label
+
+            cost = partition_cost(edges, partition, cost_data, cost_smoothness)
             if cost > cost_min:
                 raise ValueError('Cost increased. This should not happen because the graph cut is optimal.')
             cost_min = cost
@@ -223,40 +266,8 @@ def partition_faces(mesh: Trimesh, num_components: int, _lambda: float, smooth=T
 def partition2label(mesh: Trimesh, partition: NumpyTensor['f']) -> NumpyTensor['f']:
     """
     """
-    edges = trimesh.graph.face_adjacency(mesh=mesh)
-    graph = defaultdict(set)
-    for face1, face2 in edges:
-        graph[face1].add(face2)
-        graph[face2].add(face1)
-    labels = set(list(np.unique(partition)))
-    
-    components = []
-    visited = set()
-
-    def dfs(source: int):
-        stack = [source]
-        components.append({source})
-        visited.add(source)
-        
-        while stack:
-            node = stack.pop()
-            for adj in graph[node]:
-                if adj not in visited and partition[adj] == partition[node]:
-                    stack.append(adj)
-                    components[-1].add(adj)
-                    visited.add(adj)
-
-    for face in range(len(mesh.faces)):
-        if face not in visited:
-            dfs(face)
-
-    partition_output = np.zeros_like(partition)
-    label_total = 0
-    for component in components:
-        for face in component:
-            partition_output[face] = label_total
-        label_total += 1
-    return partition_output
+    components, _, _ = label_components(FaceGraph.from_mesh(mesh), partition)
+    return components.astype(partition.dtype)
 
 
 def segment_mesh_sdf(filename: Path | str, config: OmegaConf, extension='glb') -> Trimesh:
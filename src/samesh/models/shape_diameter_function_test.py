@@ -0,0 +1,64 @@
+import numpy as np
+import trimesh
+
+from samesh.models.shape_diameter_function import partition_cost, repartition, partition2label, boundary_band
+
+
+def test_partition_cost():
+    mesh = trimesh.creation.icosphere(subdivisions=2)
+    rng = np.random.default_rng(0)
+    partition = rng.integers(0, 4, len(mesh.faces))
+    cost_data = rng.random((len(mesh.faces), 4))
+    cost_smoothness = rng.random(len(mesh.face_adjacency))
+
+    expected = sum(cost_data[f, partition[f]] for f in range(len(partition)))
+    for i, (f1, f2) in enumerate(mesh.face_adjacency):
+        if partition[f1] != partition[f2]:
+            expected += cost_smoothness[i]
+    assert np.isclose(partition_cost(mesh, partition, cost_data, cost_smoothness), expected)
+
+
+def test_repartition():
+    mesh = trimesh.creation.icosphere(subdivisions=2)
+    rng = np.random.default_rng(0)
+    partition = (mesh.triangles_center[:, 2] > 0).astype(int)
+    noise = rng.random(len(mesh.faces)) < 0.1
+    partition[noise] = 1 - partition[noise]
+    cost_data = np.ones((len(mesh.faces), 2))
+    cost_data[np.arange(len(mesh.faces)), partition] = 0
+    cost_smoothness = -np.log(mesh.face_adjacency_angles / np.pi + 1e-20)
+
+    cost = partition_cost(mesh, partition, cost_data, cost_smoothness * 4)
+    refined = repartition(mesh, partition.copy(), cost_data, cost_smoothness, 1, _lambda=4)
+    assert partition_cost(mesh, refined, cost_data, cost_smoothness * 4) <= cost
+    assert len(np.unique(partition2label(mesh, refined))) < len(np.unique(partition2label(mesh, partition)))
+
+
+def test_repartition_band():
+    mesh = trimesh.creation.icosphere(subdivisions=3)
+    rng = np.random.default_rng(0)
+    partition = np.argmin(((mesh.triangles_center[:, None] - rng.normal(size=(6, 3))[None]) ** 2).sum(-1), axis=1)
+    noise = rng.random(len(mesh.faces)) < 0.05
+    partition[noise] = (partition[noise] + rng.integers(1, 6, noise.sum())) % 6
+    cost_data = np.ones((len(mesh.faces), 6))
+    cost_data[np.arange(len(mesh.faces)), partition] = 0
+    cost_smoothness = -np.log(mesh.face_adjacency_angles / np.pi + 1e-20)
+
+    band = boundary_band(mesh, partition, 1)
+    assert band[noise].all() and not band.all()
+
+    # band covering all faces is the full solve
+    refined = repartition(mesh, partition.copy(), cost_data, cost_smoothness, 1, _lambda=4)
+    refined_band = repartition(mesh, partition.copy(), cost_data, cost_smoothness, 1, _lambda=4, band_rings=64, band_max_fraction=1)
+    assert np.array_equal(refined, refined_band)
+
+    refined_band = repartition(mesh, partition.copy(), cost_data, cost_smoothness, 1, _lambda=4, band_rings=2, band_max_fraction=1)
+    assert np.array_equal(refined_band[~boundary_band(mesh, partition, 2)], partition[~boundary_band(mesh, partition, 2)])
+    assert partition_cost(mesh, refined_band, cost_data, cost_smoothness * 4) < partition_cost(mesh, partition, cost_data, cost_smoothness * 4)
+
+
+if __name__ == "__main__":
+    test_partition_cost()
+    test_repartition()
+    test_repartition_band()
+    print("All tests passed!")
@@ -16,11 +16,15 @@ OpenGL.GL.glEnable = new_gl_enable
 import pyrender
 ### END VOODOO ###
 
+from typing import Iterator
+
 import cv2
 import numpy as np
 import torch
 from numpy.random import RandomState
+from OpenGL import GL
 from PIL import Image
+from pyrender.constants import RenderFlags, ProgramFlags
 from pyrender.shader_program import ShaderProgramCache as DefaultShaderCache
 from trimesh import Trimesh, Scene
 from omegaconf import OmegaConf
@@ -30,7 +34,6 @@ from samesh.data.common import NumpyTensor
 from samesh.data.loaders import scene2mesh
 from samesh.utils.cameras import HomogeneousTransform, sample_view_matrices, sample_view_matrices_polyhedra
 from samesh.utils.math import range_norm
-from samesh.utils.mesh import duplicate_verts
 from samesh.renderer.shader_programs import *
 
 
@@ -58,6 +61,74 @@ def colormap_norms(norms: NumpyTensor['h w'], background=np.array([255, 255, 255
 DEFAULT_CAMERA_PARAMS = {'fov': 60, 'znear': 0.01, 'zfar': 16}
 
 
+class CombinedFramebuffer:
+    """
+    Offscreen framebuffer with face id (R32I), normal (RGBA8) and barycentric (RGBA8) color attachments written in one draw
+    by CombinedShaderCache programs. Face ids are read back directly as int32, so meshes are not limited to 2^24 faces.
+    Must be created and used with the renderer's GL context current.
+    """
+    def __init__(self, width: int, height: int):
+        """
+        """
+        self.width  = width
+        self.height = height
+        self.renderbuffers = GL.glGenRenderbuffers(4)
+        self.framebuffer = GL.glGenFramebuffers(1)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.framebuffer)
+        formats = [GL.GL_R32I, GL.GL_RGBA8, GL.GL_RGBA8, GL.GL_DEPTH_COMPONENT24]
+        attachments = [GL.GL_COLOR_ATTACHMENT0, GL.GL_COLOR_ATTACHMENT1, GL.GL_COLOR_ATTACHMENT2, GL.GL_DEPTH_ATTACHMENT]
+        for renderbuffer, format, attachment in zip(self.renderbuffers, formats, attachments):
+            GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, renderbuffer)
+            GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, format, width, height)
+            GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, attachment, GL.GL_RENDERBUFFER, renderbuffer)
+        GL.glDrawBuffers(3, attachments[:3])
+        assert GL.glCheckFramebufferStatus(GL.GL_FRAMEBUFFER) == GL.GL_FRAMEBUFFER_COMPLETE
+
+    def bind(self):
+        """
+        Binds and clears the framebuffer, setting background face ids to -1 and colors to white.
+        """
+        GL.glBindFramebuffer(GL.GL_DRAW_FRAMEBUFFER, self.framebuffer)
+        GL.glViewport(0, 0, self.width, self.height)
+        GL.glClearBufferiv (GL.GL_COLOR, 0, np.array([-1, 0, 0, 0], dtype=np.int32))
+        GL.glClearBufferfv (GL.GL_COLOR, 1, np.ones(4, dtype=np.float32))
+        GL.glClearBufferfv (GL.GL_COLOR, 2, np.ones(4, dtype=np.float32))
+        GL.glClearBufferfv (GL.GL_DEPTH, 0, np.ones(1, dtype=np.float32))
+
+    def read(self, znear: float, zfar: float) -> tuple[
+        NumpyTensor['h w'],
+        NumpyTensor['h w 3'],
+        NumpyTensor['h w 3'],
+        NumpyTensor['h w'],
+    ]:
+        """
+        Returns face ids, normal and barycentric colors, and linear depth (0 for background) as pyrender would.
+        """
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, self.framebuffer)
+
+        def read(attachment: int, format: int, dtype: int, np_dtype, channels: int) -> NumpyTensor:
+            GL.glReadBuffer(attachment)
+            buffer = GL.glReadPixels(0, 0, self.width, self.height, format, dtype)
+            return np.flip(np.frombuffer(buffer, dtype=np_dtype).reshape(self.height, self.width, channels), axis=0)
+
+        faces = read(GL.GL_COLOR_ATTACHMENT0, GL.GL_RED_INTEGER, GL.GL_INT, np.int32, 1)[..., 0]
+        norms = read(GL.GL_COLOR_ATTACHMENT1, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, np.uint8, 3)
+        bcent = read(GL.GL_COLOR_ATTACHMENT2, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, np.uint8, 3)
+        buffer = GL.glReadPixels(0, 0, self.width, self.height, GL.GL_DEPTH_COMPONENT, GL.GL_FLOAT)
+        depth = np.flip(np.frombuffer(buffer, dtype=np.float32).reshape(self.height, self.width), axis=0)
+        background = depth == 1.0
+        depth = 2.0 * depth - 1.0
+        depth = (2.0 * znear * zfar) / (zfar + znear - depth * (zfar - znear))
+        depth[background] = 0.0
+        return faces, norms, bcent, depth
+
+    def delete(self):
+        """
+        """
+        GL.glDeleteFramebuffers(1, [self.framebuffer])
+        GL.glDeleteRenderbuffers(4, self.renderbuffers)
+
+
 class Renderer:
     """
     """
@@ -69,37 +140,38 @@ class Renderer:
         self.shaders = {
             'default': DefaultShaderCache(),
             'normals': NormalShaderCache(),
-            'faceids': FaceidShaderCache(),
-            'barycnt': BarycentricShaderCache(),
+            'combined': CombinedShaderCache(),
         }
+        self.framebuffer_combined = None # created on first combined render
 
     def set_object(self, source: Trimesh | Scene, smooth=False):
         """
         """
+        self.faceid_offsets = {} # mesh node -> index of its first face in self.tmesh
         if isinstance(source, Scene):
             self.tmesh = scene2mesh(source)
             self.scene = pyrender.Scene(ambient_light=[1.0, 1.0, 1.0]) # RGB no direction
+            offset = 0 # scene2mesh concatenates geometry in the same order
             for name, geom in source.geometry.items():
                 if name in source.graph:
                     pose, _ = source.graph[name]
                 else:
                     pose = None
-                self.scene.add(pyrender.Mesh.from_trimesh(geom, smooth=smooth), pose=pose)
+                node = self.scene.add(pyrender.Mesh.from_trimesh(geom, smooth=smooth), pose=pose)
+                self.faceid_offsets[node] = offset
+                offset += len(geom.faces)
         
         elif isinstance(source, Trimesh):
             self.tmesh = source
             self.scene = pyrender.Scene(ambient_light=[1.0, 1.0, 1.0])
-            self.scene.add(pyrender.Mesh.from_trimesh(source, smooth=smooth))
+            node = self.scene.add(pyrender.Mesh.from_trimesh(source, smooth=smooth))
+            self.faceid_offsets[node] = 0
 
         else:
             raise ValueError(f'Invalid source type {type(source)}')
-        
-        # rearrange mesh for faceid rendering
-        self.tmesh_faceid = duplicate_verts(self.tmesh)
-        self.scene_faceid = pyrender.Scene(ambient_light=[1.0, 1.0, 1.0])
-        self.scene_faceid.add(
-            pyrender.Mesh.from_trimesh(self.tmesh_faceid, smooth=smooth)
-        )
+
+        # float32 vertex normals for render_matte interpolation, computed once per object
+        self.vertex_normals = np.asarray(self.tmesh.vertex_normals, dtype=np.float32)
 
     def set_camera(self, camera_params: dict = None):
         """
@@ -109,89 +181,229 @@ class Renderer:
         self.camera_params['yfov'] = self.camera_params['yfov'] * np.pi / 180.0
         self.camera = pyrender.PerspectiveCamera(**self.camera_params)
         
-        self.camera_node        = self.scene       .add(self.camera)
-        self.camera_node_faceid = self.scene_faceid.add(self.camera)
+        self.camera_node = self.scene.add(self.camera)
         
     def render(
         self, 
         pose: HomogeneousTransform, 
-        lightdir=np.array([0.0, 0.0, 1.0]), uv_map=False, interpolate_norms=True, blur_matte=False
+        lightdir=np.array([0.0, 0.0, 1.0]), uv_map=False, interpolate_norms=True, blur_matte=False, combined=False
     ) -> dict:
         """
+        Renders a single view with render_batch; see there for combined.
+        """
+        outputs = self.render_batch(
+            np.asarray(pose)[None], np.asarray(lightdir)[None],
+            uv_map=uv_map, interpolate_norms=interpolate_norms, blur_matte=blur_matte, combined=combined
+        )
+        return {name: output[0] for name, output in outputs.items()}
+
+    def render_batch(
+        self,
+        poses: NumpyTensor['n 4 4'],
+        lightdirs: NumpyTensor['n 3']=None, uv_map=False, interpolate_norms=True, blur_matte=False, combined=False
+    ) -> dict[str, NumpyTensor]:
         """
-        self.scene       .set_pose(self.camera_node       , pose)
-        self.scene_faceid.set_pose(self.camera_node_faceid, pose)
+        Renders all poses pass by pass, so each shader program is bound once per batch, into preallocated (n, h, w, ...) arrays.
+        Face ids and barycentric coordinates are always rendered with multiple render targets (see render_combined). If
+        combined, normals are taken from the same pass, which are face normals unless the object was set with smooth.
 
-        def render(shader: str, scene):
-            """
-            """
+        Only buffers of requested outputs are allocated: colors if uv_map, and barycentric coordinates if the matte is shaded
+        with interpolated normals, which are decoded one view at a time.
+        """
+        n = len(poses)
+        h, w = self.renderer.viewport_height, self.renderer.viewport_width
+        if lightdirs is None:
+            lightdirs = np.tile(np.array([0.0, 0.0, 1.0]), (n, 1))
+
+        passes = ['normals'] if not combined else []
+        if uv_map:
+            passes.insert(0, 'default')
+        buffers = ['normals', 'default'] if uv_map else ['normals']
+        if not uv_map and interpolate_norms:
+            buffers.append('barycnt')
+        raw = {shader: np.empty((n, h, w, 3), dtype=np.uint8) for shader in buffers}
+        raw_depth = np.empty((n, h, w), dtype=np.float32)
+        for shader in passes:
             self.renderer._renderer._program_cache = self.shaders[shader]
-            return self.renderer.render(scene)
-        
+            for i, pose in enumerate(poses):
+                self.scene.set_pose(self.camera_node, pose)
+                raw[shader][i], raw_depth[i] = self.renderer.render(self.scene)
+        faces = np.empty((n, h, w), dtype=np.int32)
+        for i, pose in enumerate(poses):
+            faces[i], raw_norms, raw_bcent, raw_depth_combined = self.render_combined(pose)
+            if 'barycnt' in raw:
+                raw['barycnt'][i] = raw_bcent
+            if combined:
+                raw['normals'][i], raw_depth[i] = raw_norms, raw_depth_combined
+
+        norms = render_norms(raw['normals'])
+        depth = np.empty((n, h, w))
+        for i in range(n): # normalized per view
+            depth[i] = render_depth(raw_depth[i])
         if uv_map:
-            raw_color, raw_depth = render('default', self.scene)
-        raw_norms, raw_depth = render('normals', self.scene)
-        raw_faces, raw_depth = render('faceids', self.scene_faceid)
-        raw_bcent, raw_depth = render('barycnt', self.scene_faceid)
-
-        def render_norms(norms: NumpyTensor['h w 3']) -> NumpyTensor['h w 3']:
-            """
-            """
-            return np.clip((norms / 255.0 - 0.5) * 2, -1, 1)
-
-        def render_depth(depth: NumpyTensor['h w'], offset=2.8, alpha=0.8) -> NumpyTensor['h w']:
-            """
-            """
-            return np.where(depth > 0, alpha * (1.0 - range_norm(depth, offset=offset)), 1)
-
-        def render_faces(faces: NumpyTensor['h w 3']) -> NumpyTensor['h w']:
-            """
-            """
-            faces = faces.astype(np.int32)
-            faces = faces[:, :, 0] * 65536 + faces[:, :, 1] * 256 + faces[:, :, 2]
-            faces[faces == (256 ** 3 - 1)] = -1 # set background to -1
-            return faces
-
-        def render_bcent(bcent: NumpyTensor['h w 3']) -> NumpyTensor['h w 3']:
-            """
-            """
-            return np.clip(bcent / 255.0, 0, 1)
-
-        def render_matte(
-            norms: NumpyTensor['h w 3'],
-            depth: NumpyTensor['h w'],
-            faces: NumpyTensor['h w'],
-            bcent: NumpyTensor['h w 3'],
-            alpha=0.5, beta=0.25, gaussian_kernel_width=5, gaussian_sigma=1,
-        ) -> NumpyTensor['h w 3']:
-            """
-            """
-            if interpolate_norms: # NOTE requires process=True
-                verts_index = self.tmesh.faces[faces.reshape(-1)]    # (n, 3)
-                verts_norms = self.tmesh.vertex_normals[verts_index] # (n, 3, 3)
-                norms = np.sum(verts_norms * bcent.reshape(-1, 3, 1), axis=1)
-                norms = norms.reshape(bcent.shape)
-
-            diffuse = np.sum(norms * lightdir, axis=2)
-            diffuse = np.clip(diffuse, -1, 1)
-            matte = 255 * (diffuse[:, :, None] * alpha + beta)
-            matte = np.where(depth[:, :, None] > 0, matte, 255)
-            matte = np.clip(matte, 0, 255).astype(np.uint8)
-            matte = np.repeat(matte, 3, axis=2)
-            
-            if blur_matte:
-                matte = (faces == -1)[:, :, None] * matte + \
-                        (faces != -1)[:, :, None] * cv2.GaussianBlur(matte, (gaussian_kernel_width, gaussian_kernel_width), gaussian_sigma)
-            return matte 
-
-        norms = render_norms(raw_norms)
-        depth = render_depth(raw_depth)
-        faces = render_faces(raw_faces)
-        bcent = render_bcent(raw_bcent)
-        matte = raw_color if uv_map else render_matte(norms, raw_depth, faces, bcent) # use original depth for matte
+            matte = raw['default']
+        else:
+            matte = np.empty((n, h, w, 3), dtype=np.uint8)
+            for i in range(n): # use original depth for matte
+                bcent = render_bcent(raw['barycnt'][i]) if 'barycnt' in raw else None
+                matte[i] = render_matte(
+                    self.tmesh, norms[i], raw_depth[i], faces[i], bcent, lightdirs[i],
+                    interpolate_norms=interpolate_norms, blur_matte=blur_matte, vertex_normals=self.vertex_normals
+                )
 
         return {'norms': norms, 'depth': depth, 'matte': matte, 'faces': faces}
 
+    def render_combined(self, pose: HomogeneousTransform) -> tuple[
+        NumpyTensor['h w'],
+        NumpyTensor['h w 3'],
+        NumpyTensor['h w 3'],
+        NumpyTensor['h w'],
+    ]:
+        """
+        Renders face ids, normal and barycentric colors, and depth in one draw into CombinedFramebuffer. Face ids are primitive
+        ids offset by the first face of each mesh node, so no per face vertex duplication is needed. Mirrors pyrender's
+        forward pass without lighting.
+        """
+        renderer = self.renderer._renderer
+        h, w = self.renderer.viewport_height, self.renderer.viewport_width
+        flags = RenderFlags.OFFSCREEN
+        self.renderer._platform.make_current()
+        if self.framebuffer_combined is None or (self.framebuffer_combined.height, self.framebuffer_combined.width) != (h, w):
+            if self.framebuffer_combined is not None:
+                self.framebuffer_combined.delete()
+            self.framebuffer_combined = CombinedFramebuffer(w, h)
+
+        scene = self.scene
+        scene.set_pose(self.camera_node, pose)
+        renderer._program_cache = self.shaders['combined']
+        renderer._update_context(scene, flags)
+
+        self.framebuffer_combined.bind()
+        GL.glEnable(GL.GL_DEPTH_TEST)
+        GL.glDepthMask(GL.GL_TRUE)
+        GL.glDepthFunc(GL.GL_LESS)
+        GL.glDepthRange(0.0, 1.0)
+        V, P = renderer._get_camera_matrices(scene)
+        program = None
+        for node in renderer._sorted_mesh_nodes(scene):
+            if not node.mesh.is_visible:
+                continue
+            for primitive in node.mesh.primitives:
+                program = renderer._get_primitive_program(primitive, flags, ProgramFlags.USE_MATERIAL)
+                program._bind()
+                program.set_uniform('V', V)
+                program.set_uniform('P', P)
+                program.set_uniform('faceid_offset', self.faceid_offsets[node])
+                renderer._bind_and_draw_primitive(primitive=primitive, pose=scene.get_pose(node), program=program, flags=flags)
+                renderer._reset_active_textures()
+        if program is not None:
+            program._unbind()
+        GL.glFlush()
+        return self.framebuffer_combined.read(self.camera.znear, self.camera.zfar)
+
+
+def render_norms(norms: NumpyTensor['... 3']) -> NumpyTensor['... 3']:
+    """
+    """
+    return np.clip((norms / 255.0 - 0.5) * 2, -1, 1)
+
+
+def render_depth(depth: NumpyTensor['h w'], offset=2.8, alpha=0.8) -> NumpyTensor['h w']:
+    """
+    """
+    return np.where(depth > 0, alpha * (1.0 - range_norm(depth, offset=offset)), 1)
+
+
+def render_bcent(bcent: NumpyTensor['... 3']) -> NumpyTensor['... 3']:
+    """
+    """
+    return np.clip(bcent / 255.0, 0, 1)
+
+
+def render_matte(
+    tmesh: Trimesh,
+    norms: NumpyTensor['h w 3'],
+    depth: NumpyTensor['h w'],
+    faces: NumpyTensor['h w'],
+    bcent: NumpyTensor['h w 3'],
+    lightdir: NumpyTensor['3'],
+    interpolate_norms=True, blur_matte=False,
+    alpha=0.5, beta=0.25, gaussian_kernel_width=5, gaussian_sigma=1,
+    vertex_normals: NumpyTensor['v 3']=None,
+) -> NumpyTensor['h w 3']:
+    """
+    If interpolate_norms, normals of foreground pixels are interpolated in float32 from vertex_normals (defaults to
+    tmesh.vertex_normals) using barycentric coordinates; background pixels keep the rendered normals.
+    """
+    if interpolate_norms: # NOTE requires process=True
+        if vertex_normals is None:
+            vertex_normals = np.asarray(tmesh.vertex_normals, dtype=np.float32)
+        foreground = faces != -1
+        verts_index = tmesh.faces[faces[foreground]]    # (m, 3)
+        verts_norms = vertex_normals[verts_index]        # (m, 3, 3)
+        norms = norms.astype(np.float32)
+        norms[foreground] = np.einsum('mij,mi->mj', verts_norms, bcent[foreground].astype(np.float32))
+
+    diffuse = np.sum(norms * lightdir, axis=2)
+    diffuse = np.clip(diffuse, -1, 1)
+    matte = 255 * (diffuse[:, :, None] * alpha + beta)
+    matte = np.where(depth[:, :, None] > 0, matte, 255)
+    matte = np.clip(matte, 0, 255).astype(np.uint8)
+    matte = np.repeat(matte, 3, axis=2)
+    
+    if blur_matte:
+        matte = (faces == -1)[:, :, None] * matte + \
+                (faces != -1)[:, :, None] * cv2.GaussianBlur(matte, (gaussian_kernel_width, gaussian_kernel_width), gaussian_sigma)
+    return matte 
+
+
+def sample_multiview_poses(
+    camera_generation_method='sphere', sampling_args: dict=None, lookat_position=np.array([0, 0, 0])
+) -> HomogeneousTransform:
+    """
+    """
+    lookat_position_torch = torch.from_numpy(lookat_position)
+    if camera_generation_method == 'sphere':
+        return sample_view_matrices(lookat_position=lookat_position_torch, **sampling_args).numpy()
+    return sample_view_matrices_polyhedra(camera_generation_method, lookat_position=lookat_position_torch, **sampling_args).numpy()
+
+
+def compute_lightdir(pose: HomogeneousTransform, lookat_position=np.array([0, 0, 0])) -> NumpyTensor[3]:
+    """
+    """
+    lightdir = pose[:3, 3] - (lookat_position)
+    return lightdir / np.linalg.norm(lightdir)
+
+
+def render_multiview_iter(
+    renderer: Renderer,
+    camera_generation_method='sphere',
+    renderer_args: dict=None,
+    sampling_args: dict=None,
+    lighting_args: dict=None, 
+    lookat_position=np.array([0, 0, 0]),
+    verbose=True,
+    poses: HomogeneousTransform=None,
+    batch_size=1,
+) -> Iterator[dict]:
+    """
+    Renders views batch_size at a time and yields them one at a time. Pass poses to render fixed views instead of sampling them.
+    """
+    views = poses if poses is not None else sample_multiview_poses(camera_generation_method, sampling_args, lookat_position)
+
+    progress = tqdm(total=len(views), desc='Rendering Multiviews...', disable=not verbose)
+    for be in range(0, len(views), batch_size):
+        batch = views[be:be + batch_size]
+        lightdirs = np.stack([compute_lightdir(pose, lookat_position) for pose in batch])
+        outputs = renderer.render_batch(batch, lightdirs, **(renderer_args or {}))
+        for i, pose in enumerate(batch):
+            render = {name: output[i] for name, output in outputs.items()}
+            render['matte'] = Image.fromarray(render['matte'])
+            render['poses'] = pose
+            progress.update(1)
+            yield render
+    progress.close()
+
 
 def render_multiview(
     renderer: Renderer,
@@ -203,27 +415,17 @@ def render_multiview(
     verbose=True,
 ) -> list[Image.Image]:
     """
+    Renders all views in one batch.
     """
-    lookat_position_torch = torch.from_numpy(lookat_position)
-    if camera_generation_method == 'sphere':
-        views = sample_view_matrices(lookat_position=lookat_position_torch, **sampling_args).numpy()
-    else:
-        views = sample_view_matrices_polyhedra(camera_generation_method, lookat_position=lookat_position_torch, **sampling_args).numpy()
-    
-    def compute_lightdir(pose: HomogeneousTransform) -> NumpyTensor[3]:
-        """
-        """
-        lightdir = pose[:3, 3] - (lookat_position)
-        return lightdir / np.linalg.norm(lightdir)
-
-    renders = []
-    if verbose:
-        views = tqdm(views, 'Rendering Multiviews...')
-    for pose in views:
-        outputs = renderer.render(pose, lightdir=compute_lightdir(pose), **renderer_args)
-        outputs['matte'] = Image.fromarray(outputs['matte'])
-        outputs['poses'] = pose
-        renders.append(outputs)
+    poses = sample_multiview_poses(camera_generation_method, sampling_args, lookat_position)
+    renders = list(render_multiview_iter(
+        renderer, 
+        renderer_args=renderer_args,
+        lookat_position=lookat_position,
+        verbose=verbose,
+        poses=poses,
+        batch_size=len(poses),
+    ))
     return {
         name: [render[name] for render in renders] for name in renders[0].keys()
     }
@@ -0,0 +1,158 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import trimesh
+from omegaconf import OmegaConf
+
+from samesh.renderer import renderer as renderer_module
+from samesh.renderer.renderer import CombinedFramebuffer, Renderer, render_bcent, render_matte, sample_multiview_poses
+
+
+def create_renderer(tmesh: trimesh.Trimesh, **config) -> Renderer:
+    """
+    Returns a renderer with tmesh set, or skips the test if no GL context can be created.
+    """
+    try:
+        renderer = Renderer(OmegaConf.create({'target_dim': [64, 48], **config}))
+    except Exception as e:
+        pytest.skip(f'no GL context: {e}')
+    renderer.set_object(tmesh)
+    renderer.set_camera()
+    return renderer
+
+
+def test_sample_multiview_poses():
+    lookat = np.array([0.5, -0.25, 1.0])
+    poses = sample_multiview_poses('icosahedron', {'radius': 2}, lookat)
+    assert poses.shape == (12, 4, 4)
+    for pose in poses:
+        assert np.allclose(pose[:3, :3] @ pose[:3, :3].T, np.eye(3), atol=1e-5)
+        assert np.allclose(np.linalg.norm(pose[:3, 3] - lookat), 2, atol=1e-5)
+        forward = -pose[:3, 2] # OpenGL cameras look down -z
+        assert np.allclose(forward, (lookat - pose[:3, 3]) / 2, atol=1e-5)
+
+    poses = sample_multiview_poses('sphere', {'n': 5, 'radius': 3})
+    assert poses.shape == (5, 4, 4)
+    assert np.allclose(np.linalg.norm(poses[:, :3, 3], axis=1), 3, atol=1e-5)
+
+
+def test_combined_framebuffer_read(monkeypatch):
+    h, w, znear, zfar = 3, 4, 0.1, 10.0
+    rng = np.random.default_rng(0)
+    faces = rng.integers(-1, 2**30, size=(h, w), dtype=np.int32) # beyond 2^24
+    norms = rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8)
+    bcent = rng.dirichlet(np.ones(3), size=(h, w))
+    bcent_encoded = np.round(bcent * 255).astype(np.uint8)
+    depth = rng.uniform(znear, zfar, size=(h, w))
+    depth[faces == -1] = 0
+    ndc = (zfar + znear - 2 * znear * zfar / np.where(depth > 0, depth, 1)) / (zfar - znear)
+    window_depth = np.where(depth > 0, (ndc + 1) / 2, 1).astype(np.float32)
+
+    # GL reads rows bottom to top
+    attachments = {'faces': faces, 'norms': norms, 'bcent': bcent_encoded}
+    state = {}
+    GL = SimpleNamespace(
+        GL_READ_FRAMEBUFFER=0, GL_COLOR_ATTACHMENT0='faces', GL_COLOR_ATTACHMENT1='norms', GL_COLOR_ATTACHMENT2='bcent',
+        GL_RED_INTEGER=0, GL_RGB=1, GL_DEPTH_COMPONENT=2, GL_INT=0, GL_UNSIGNED_BYTE=1, GL_FLOAT=2,
+        glBindFramebuffer=lambda target, framebuffer: None,
+        glReadBuffer=lambda attachment: state.update(attachment=attachment),
+        glReadPixels=lambda x, y, width, height, format, dtype: np.ascontiguousarray(np.flip(
+            window_depth if format == GL.GL_DEPTH_COMPONENT else attachments[state['attachment']], axis=0
+        )).tobytes(),
+    )
+    monkeypatch.setattr(renderer_module, 'GL', GL)
+    framebuffer = object.__new__(CombinedFramebuffer)
+    framebuffer.width, framebuffer.height, framebuffer.framebuffer = w, h, 0
+    faces_read, norms_read, bcent_read, depth_read = framebuffer.read(znear, zfar)
+    assert np.array_equal(faces_read, faces)
+    assert np.array_equal(norms_read, norms)
+    assert np.array_equal(bcent_read, bcent_encoded)
+    assert np.allclose(depth_read, depth, rtol=1e-4)
+    assert np.all(depth_read[faces == -1] == 0)
+
+    decoded = render_bcent(bcent_read)
+    assert np.allclose(decoded, bcent, atol=0.5 / 255 + 1e-9)
+    assert np.allclose(decoded.sum(axis=-1), 1, atol=1.5 / 255)
+
+
+def test_render_matte():
+    tmesh = trimesh.creation.icosphere(subdivisions=1)
+    h, w = 6, 7
+    rng = np.random.default_rng(0)
+    faces = rng.integers(-1, len(tmesh.faces), size=(h, w))
+    faces[0, 0] = -1
+    depth = np.where(faces != -1, rng.uniform(1, 3, size=(h, w)), 0)
+    norms = rng.normal(size=(h, w, 3))
+    norms /= np.linalg.norm(norms, axis=2, keepdims=True)
+    bcent = rng.dirichlet(np.ones(3), size=(h, w))
+    lightdir = np.array([0.0, 0.6, 0.8])
+
+    def reference(interpolate_norms: bool) -> np.ndarray:
+        matte = np.empty((h, w, 3), dtype=np.uint8)
+        for i in range(h):
+            for j in range(w):
+                norm = norms[i, j]
+                if interpolate_norms and faces[i, j] != -1:
+                    norm = bcent[i, j] @ tmesh.vertex_normals[tmesh.faces[faces[i, j]]]
+                diffuse = np.clip(norm @ lightdir, -1, 1)
+                matte[i, j] = np.clip(255 * (diffuse * 0.5 + 0.25), 0, 255) if depth[i, j] > 0 else 255
+        return matte
+
+    for interpolate_norms in [True, False]:
+        matte = render_matte(tmesh, norms, depth, faces, bcent, lightdir, interpolate_norms=interpolate_norms)
+        assert matte.dtype == np.uint8
+        assert np.abs(matte.astype(int) - reference(interpolate_norms)).max() <= 1 # float32 interpolation
+    assert np.all(matte[0, 0] == 255)
+    vertex_normals = np.asarray(tmesh.vertex_normals, dtype=np.float32)
+    assert np.array_equal(
+        render_matte(tmesh, norms, depth, faces, bcent, lightdir),
+        render_matte(tmesh, norms, depth, faces, bcent, lightdir, vertex_normals=vertex_normals),
+    )
+
+
+def test_render_combined():
+    tmesh = trimesh.creation.icosphere(subdivisions=2, radius=0.5)
+    renderer = create_renderer(tmesh)
+    for pose in sample_multiview_poses('icosahedron', {'radius': 2})[:3]:
+        faces, norms, bcent, depth = renderer.render_combined(pose)
+        renderer.renderer._renderer._program_cache = renderer.shaders['normals']
+        renderer.scene.set_pose(renderer.camera_node, pose)
+        norms_pass, depth_pass = renderer.renderer.render(renderer.scene)
+
+        foreground = faces != -1
+        assert foreground.any()
+        assert np.array_equal(foreground, depth > 0)
+        assert np.mean(foreground == (depth_pass > 0)) > 0.99
+        both = foreground & (depth_pass > 0)
+        assert np.allclose(depth[both], depth_pass[both], atol=1e-3)
+        assert np.mean(np.abs(norms[both].astype(int) - norms_pass[both]) <= 2) > 0.99
+
+        # points reconstructed from face ids and barycentric coordinates lie at the rendered depth
+        bcent_decoded = render_bcent(bcent[foreground])
+        points = np.einsum('mij,mi->mj', tmesh.vertices[tmesh.faces[faces[foreground]]], bcent_decoded)
+        points_camera = (np.linalg.inv(pose) @ np.c_[points, np.ones(len(points))].T).T
+        assert np.allclose(-points_camera[:, 2], depth[foreground], atol=5e-3)
+        assert np.all(np.sum(tmesh.face_normals[faces[foreground]] * (pose[:3, 3] - points), axis=1) > 0)
+
+
+def test_render_batch():
+    tmesh = trimesh.creation.icosphere(subdivisions=2, radius=0.5)
+    renderer = create_renderer(tmesh)
+    poses = sample_multiview_poses('icosahedron', {'radius': 2})[:3]
+    lightdirs = poses[:, :3, 3] / np.linalg.norm(poses[:, :3, 3], axis=1, keepdims=True)
+    for kwargs in [{}, {'interpolate_norms': False}, {'uv_map': True}, {'combined': True}]:
+        batch = renderer.render_batch(poses, lightdirs, **kwargs)
+        for i, (pose, lightdir) in enumerate(zip(poses, lightdirs)):
+            outputs = renderer.render(pose, lightdir, **kwargs)
+            assert outputs.keys() == batch.keys()
+            for name, output in outputs.items():
+                assert np.array_equal(output, batch[name][i]), name
+        assert (batch['faces'] != -1).any()
+
+
+if __name__ == "__main__":
+    test_sample_multiview_poses()
+    test_render_matte()
+    test_render_combined()
+    test_render_batch()
@@ -26,8 +26,10 @@ class NormalShaderCache:
         return self.program
 
 
-class BarycentricShaderCache:
+class CombinedShaderCache:
     """
+    Writes face ids, normals and barycentric coordinates to three render targets in one draw (see CombinedFramebuffer).
+    Face ids are primitive ids offset by the faceid_offset uniform.
     """
     def __init__(self):
         self.program = None
@@ -36,25 +38,9 @@ class BarycentricShaderCache:
         """
         """
         self.program = self.program or pyrender.shader_program.ShaderProgram(
-            f'{SHADERS_PATH}/barycentric.vert', 
-            f'{SHADERS_PATH}/barycentric.frag',
+            f'{SHADERS_PATH}/combined.vert', 
+            f'{SHADERS_PATH}/combined.frag',
+            geometry_shader=f'{SHADERS_PATH}/combined.geom',
             defines=defines
         )
         return self.program
-
-
-class FaceidShaderCache:
-    """
-    """
-    def __init__(self):
-        self.program = None
-
-    def get_program(self, vertex_shader, fragment_shader, geometry_shader=None, defines=None):
-        """
-        """
-        self.program = self.program or pyrender.shader_program.ShaderProgram(
-            f'{SHADERS_PATH}/faceid.vert', 
-            f'{SHADERS_PATH}/faceid.frag',
-            defines=defines
-        )
-        return self.program
\ No newline at end of file
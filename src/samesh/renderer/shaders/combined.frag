@@ -0,0 +1,20 @@
+#version 330 core
+
+in vec3 frag_normal;
+in float frag_x;
+in float frag_y;
+
+// Uniforms
+uniform int faceid_offset; // faces of preceding meshes in the scene
+
+// Render targets
+layout(location = 0) out int  frag_faceid;
+layout(location = 1) out vec4 frag_norms;
+layout(location = 2) out vec4 frag_bcent;
+
+void main()
+{
+    frag_faceid = gl_PrimitiveID + faceid_offset;
+    frag_norms  = vec4(normalize(frag_normal) * 0.5 + 0.5, 1.0);
+    frag_bcent  = vec4(frag_x, frag_y, 1.0 - frag_x - frag_y, 1.0);
+}
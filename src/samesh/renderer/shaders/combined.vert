@@ -2,6 +2,7 @@
 
 // Vertex Attributes
 layout(location = 0) in vec3 position;
+layout(location = NORMAL_LOC) in vec3 normal;
 layout(location = INST_M_LOC) in mat4 inst_m;
 
 // Uniforms
@@ -10,12 +11,12 @@ uniform mat4 V;
 uniform mat4 P;
 
 // Outputs
-flat out int faceid;
+out vec3 geom_normal;
 
 void main()
 {
     gl_Position = P * V * M * inst_m * vec4(position, 1.0);
-    
-    // assumes mesh has been constructed so same face vertices are adjacent and duplicated for each face
-    faceid = int(gl_VertexID / 3);
-}
\ No newline at end of file
+
+    mat4 N = transpose(inverse(M * inst_m));
+    geom_normal = normalize(vec3(N * vec4(normal, 0.0)));
+}
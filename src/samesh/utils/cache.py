@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import shutil
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+from PIL import Image
+
+from samesh.data.common import NumpyTensor
+from samesh.utils.masks import PackedMasks
+
+
+RENDER_CACHE_VERSION = 1
+RENDER_CACHE_NAMES   = ['matte', 'sdf', 'faces', 'norms', 'norms_masked', 'bmasks', 'cmasks', 'poses']
+RENDER_CACHE_DTYPES  = { # compact dtypes, other kinds keep their own
+    'faces'       : np.int32,
+    'norms'       : np.float16,
+    'norms_masked': np.float16,
+    'cmasks'      : np.int32,
+    'matte'       : np.uint8,
+    'sdf'         : np.uint8,
+}
+RENDER_CACHE_IMAGES = ['matte', 'sdf'] # loaded as PIL images
+RENDER_CACHE_PACKED = ['bmasks']       # variable number of binary masks per view, stored and loaded as PackedMasks
+
+
+class LazyViews(Sequence):
+    """
+    Read only sequence that computes each view on access, e.g. from a memory mapped array.
+    """
+    def __init__(self, length: int, getter: Callable[[int], object]):
+        """
+        """
+        self.length = length
+        self.getter = getter
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(f'View index {index} out of range for {self.length} views')
+        return self.getter(index)
+
+
+class RenderCacheWriter:
+    """
+    Writes views of a mesh to a render cache one view at a time, appending each kind to its own stacked file, so views can
+    be written as they are computed:
+
+        with RenderCacheWriter(path) as writer:
+            for item in items:
+                writer.append(item)
+
+    The metadata file, which marks the cache as complete, is only written when the writer is closed without error. If
+    compress, the stacked files are merged into a single compressed npz on close, which cannot be memory mapped.
+    """
+    def __init__(self, path: Path | str, compress=False):
+        """
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.compress = compress
+        self.files = {}
+        self.metadata = {'version': RENDER_CACHE_VERSION, 'num_views': 0, 'compressed': compress, 'arrays': {}}
+
+    def append(self, item: dict) -> None:
+        """
+        Appends one view. Kinds not in RENDER_CACHE_NAMES, e.g. depth, are not cached.
+        """
+        missing = [name for name in self.files if name not in item]
+        if missing:
+            raise ValueError(f'Kinds {missing} are missing from view {self.metadata["num_views"]}')
+        for name in RENDER_CACHE_NAMES:
+            if name not in item:
+                continue
+            if name in RENDER_CACHE_PACKED:
+                masks = item[name] if isinstance(item[name], PackedMasks) else PackedMasks.pack(np.asarray(item[name]))
+                array, width = masks.data, masks.width
+            else:
+                array = np.asarray(item[name])
+            array = np.ascontiguousarray(array, dtype=RENDER_CACHE_DTYPES.get(name, array.dtype))
+            shape = list(array.shape[1:] if name in RENDER_CACHE_PACKED else array.shape)
+
+            if name not in self.files:
+                if self.metadata['num_views'] > 0:
+                    raise ValueError(f'Kind {name} is missing from previous views')
+                self.files[name] = open(self.path / f'{name}.bin', 'wb')
+                self.metadata['arrays'][name] = {'dtype': array.dtype.str, 'shape': shape}
+                if name in RENDER_CACHE_PACKED:
+                    self.metadata['arrays'][name].update({'width': width, 'counts': []})
+            if self.metadata['arrays'][name]['shape'] != shape:
+                raise ValueError(f'Kind {name} has shape {shape}, expected {self.metadata["arrays"][name]["shape"]}')
+            if name in RENDER_CACHE_PACKED:
+                self.metadata['arrays'][name]['counts'].append(len(array))
+            self.files[name].write(array.tobytes())
+        self.metadata['num_views'] += 1
+
+    def close(self) -> None:
+        """
+        """
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+        if self.compress:
+            arrays = read_arrays(self.path, self.metadata)
+            np.savez_compressed(self.path / 'renders.npz', **arrays)
+            del arrays
+            for name in self.metadata['arrays']:
+                os.remove(self.path / f'{name}.bin')
+        with open(self.path / 'renders.json', 'w') as f:
+            json.dump(self.metadata, f)
+
+    def abort(self) -> None:
+        """
+        Closes the stacked files without writing the metadata file, so the cache is never considered complete.
+        """
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_arrays(path: Path, metadata: dict) -> dict[str, NumpyTensor]:
+    """
+    Memory maps the stacked arrays of each kind, where packed kinds are stacked over all masks of all views.
+    """
+    arrays = {}
+    for name, info in metadata['arrays'].items():
+        length = sum(info['counts']) if name in RENDER_CACHE_PACKED else metadata['num_views']
+        shape = (length, *info['shape'])
+        if np.prod(shape) == 0: # empty files cannot be memory mapped
+            arrays[name] = np.empty(shape, dtype=info['dtype'])
+        else:
+            arrays[name] = np.memmap(path / f'{name}.bin', dtype=info['dtype'], mode='r', shape=shape)
+    return arrays
+
+
+def render_cache_exists(path: Path | str) -> bool:
+    """
+    """
+    return (Path(path) / 'renders.json').exists()
+
+
+def load_render_cache(path: Path | str) -> dict[str, Sequence]:
+    """
+    Returns the cached views of each kind. Arrays are memory mapped, so only views that are accessed are read from disk,
+    unless the cache is compressed, in which case each kind is decompressed on load. Images are returned as PIL images and
+    binary masks as PackedMasks.
+    """
+    path = Path(path)
+    with open(path / 'renders.json') as f:
+        metadata = json.load(f)
+    if metadata['version'] != RENDER_CACHE_VERSION:
+        raise ValueError(f'Unsupported render cache version {metadata["version"]}')
+
+    if metadata['compressed']:
+        with np.load(path / 'renders.npz') as data:
+            arrays = {name: data[name] for name in metadata['arrays']}
+    else:
+        arrays = read_arrays(path, metadata)
+
+    num_views = metadata['num_views']
+    items = {}
+    for name, array in arrays.items():
+        if name in RENDER_CACHE_PACKED:
+            info = metadata['arrays'][name]
+            offsets = np.concatenate([[0], np.cumsum(info['counts'], dtype=np.int64)])
+            masks = lambda i, array=array, offsets=offsets, width=info['width']: \
+                PackedMasks(array[offsets[i]:offsets[i + 1]], width)
+            items[name] = LazyViews(num_views, masks)
+        elif name in RENDER_CACHE_IMAGES:
+            items[name] = LazyViews(num_views, lambda i, array=array: Image.fromarray(np.asarray(array[i])))
+        else:
+            items[name] = array
+    return items
+
+
+def hash_key(*parts) -> str:
+    """
+    Hash of json serializable parts e.g. a previous key and the settings of a stage.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class StageCache:
+    """
+    Content addressed cache of pipeline stages, where each entry is a directory root/stage/key filled by the caller between
+    create and commit:
+
+        path = cache.lookup(stage, key)
+        if path is None:
+            path = cache.create(stage, key)
+            ... # write entry files under path
+            cache.commit(stage, key)
+
+    Lookups mark entries as used. If max_bytes is given, least recently used entries are evicted on commit until the cache
+    fits. Entries without a committed marker, e.g. from interrupted runs, are never returned and are overwritten by create
+    or removed by discard.
+    """
+    MARKER = 'entry.json'
+
+    def __init__(self, root: Path | str, max_bytes: int=None):
+        """
+        """
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+
+    def path(self, stage: str, key: str) -> Path:
+        """
+        """
+        return self.root / stage / key
+
+    def lookup(self, stage: str, key: str) -> Path | None:
+        """
+        """
+        marker = self.path(stage, key) / self.MARKER
+        if not marker.exists():
+            return None
+        os.utime(marker) # modification time of marker is time of last use
+        return marker.parent
+
+    def create(self, stage: str, key: str) -> Path:
+        """
+        """
+        path = self.path(stage, key)
+        if path.exists():
+            shutil.rmtree(path)
+        path.mkdir(parents=True)
+        return path
+
+    def commit(self, stage: str, key: str) -> None:
+        """
+        """
+        path = self.path(stage, key)
+        size = sum(file.stat().st_size for file in path.rglob('*') if file.is_file())
+        with open(path / self.MARKER, 'w') as f:
+            json.dump({'stage': stage, 'key': key, 'size': size}, f)
+        if self.max_bytes is not None:
+            self.evict(keep=path)
+
+    def discard(self, stage: str, key: str) -> None:
+        """
+        Removes an entry e.g. one left uncommitted by an interrupted write.
+        """
+        shutil.rmtree(self.path(stage, key), ignore_errors=True)
+
+    def entries(self) -> list[tuple[float, int, Path]]:
+        """
+        Returns last use time, size and path of each committed entry.
+        """
+        entries = []
+        for marker in self.root.glob(f'*/*/{self.MARKER}'):
+            with open(marker) as f:
+                size = json.load(f)['size']
+            entries.append((marker.stat().st_mtime, size, marker.parent))
+        return entries
+
+    def evict(self, keep: Path=None) -> None:
+        """
+        Removes least recently used entries other than keep until the cache fits in max_bytes.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
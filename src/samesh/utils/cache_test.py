@@ -0,0 +1,88 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from samesh.utils.cache import RenderCacheWriter, StageCache, hash_key, load_render_cache, render_cache_exists
+
+
+def test_render_cache():
+    rng = np.random.default_rng(0)
+    items = []
+    for i in range(3):
+        items.append({
+            'matte' : Image.fromarray(rng.integers(0, 255, (8, 12, 3), dtype=np.uint8)),
+            'faces' : rng.integers(-1, 100, (8, 12)),
+            'norms' : rng.uniform(-1, 1, (8, 12, 3)),
+            'bmasks': rng.uniform(size=(i + 1, 8, 12)) > 0.5, # number of masks varies per view
+            'cmasks': rng.integers(0, 4, (8, 12)),
+            'poses' : np.eye(4) * i,
+            'depth' : rng.uniform(size=(8, 12)), # not cached
+        })
+
+    for compress in [False, True]:
+        with tempfile.TemporaryDirectory() as path:
+            with RenderCacheWriter(path, compress=compress) as writer:
+                for item in items:
+                    writer.append(item)
+            assert render_cache_exists(path)
+            assert (Path(path) / 'renders.npz').exists() == compress
+
+            cached = load_render_cache(path)
+            assert 'depth' not in cached
+            assert cached['faces'].dtype == np.int32
+            assert cached['norms'].dtype == np.float16
+            for i, item in enumerate(items):
+                assert np.array_equal(np.asarray(cached['matte'][i]), np.asarray(item['matte']))
+                assert np.array_equal(cached['faces' ][i], item['faces' ])
+                assert np.array_equal(cached['bmasks'][i].dense(), item['bmasks'])
+                assert np.array_equal(cached['cmasks'][i], item['cmasks'])
+                assert np.array_equal(cached['poses' ][i], item['poses' ])
+                assert np.allclose(cached['norms'][i], item['norms'], atol=1e-3)
+            del cached
+
+
+def test_render_cache_incomplete():
+    with tempfile.TemporaryDirectory() as path:
+        try:
+            with RenderCacheWriter(path) as writer:
+                writer.append({'faces': np.zeros((2, 2))})
+                writer.append({'faces': np.zeros((2, 3))})
+        except ValueError:
+            pass
+        assert not render_cache_exists(path)
+
+
+def test_stage_cache():
+    assert hash_key('mesh', {'a': 1, 'b': 2}) == hash_key('mesh', {'b': 2, 'a': 1})
+    assert hash_key('mesh', {'a': 1}) != hash_key('mesh', {'a': 2})
+
+    with tempfile.TemporaryDirectory() as root:
+        cache = StageCache(root, max_bytes=2500)
+        for key in ['a', 'b']:
+            assert cache.lookup('renders', key) is None
+            path = cache.create('renders', key)
+            (path / 'data.bin').write_bytes(bytes(1000))
+            cache.commit('renders', key)
+        os.utime(Path(root) / 'renders' / 'a' / StageCache.MARKER, (0, 0)) # a is least recently used
+        assert cache.lookup('masks', 'a') is None
+
+        path = cache.create('masks', 'a') # uncommitted entries are never returned
+        assert cache.lookup('masks', 'a') is None
+        (path / 'data.bin').write_bytes(bytes(1000))
+        cache.commit('masks', 'a')
+        assert cache.lookup('renders', 'a') is None # evicted
+        assert cache.lookup('renders', 'b') is not None
+        assert cache.lookup('masks',   'a') is not None
+
+        cache.create('masks', 'b') # e.g. interrupted before commit
+        cache.discard('masks', 'b')
+        assert not cache.path('masks', 'b').exists()
+
+
+if __name__ == "__main__":
+    test_render_cache()
+    test_render_cache_incomplete()
+    test_stage_cache()
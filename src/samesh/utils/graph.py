@@ -0,0 +1,176 @@
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from trimesh.base import Trimesh
+
+from samesh.data.common import NumpyTensor
+
+
+class FaceGraph:
+    """
+    Face adjacency of a mesh in CSR format, where the neighbors of face f are indices[indptr[f]:indptr[f + 1]] in
+    ascending order:
+
+        ...
+        graph = FaceGraph.from_mesh(mesh)
+        for adj in graph.neighbors(face):
+            ...
+    """
+    def __init__(self, indptr: NumpyTensor['f+1'], indices: NumpyTensor['n']):
+        """
+        """
+        self.indptr  = indptr
+        self.indices = indices
+        self._sources = None
+
+    @classmethod
+    def from_edges(cls, edges: NumpyTensor['e 2'], num_faces: int) -> 'FaceGraph':
+        """
+        """
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        rows = np.concatenate([edges[:, 0], edges[:, 1]])
+        cols = np.concatenate([edges[:, 1], edges[:, 0]])
+        adjacency = sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(num_faces, num_faces))
+        adjacency.sum_duplicates() # removes duplicate edges
+        adjacency.sort_indices()
+        return cls(adjacency.indptr.astype(np.int64), adjacency.indices.astype(np.int32))
+
+    @classmethod
+    def from_mesh(cls, mesh: Trimesh) -> 'FaceGraph':
+        """
+        """
+        return cls.from_edges(mesh.face_adjacency, len(mesh.faces))
+
+    @classmethod
+    def load(cls, path: Path | str) -> 'FaceGraph':
+        """
+        """
+        data = np.load(path)
+        return cls(data['indptr'], data['indices'])
+
+    def save(self, path: Path | str) -> None:
+        """
+        """
+        np.savez(path, indptr=self.indptr, indices=self.indices)
+
+    @property
+    def num_faces(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def degrees(self) -> NumpyTensor['f']:
+        return np.diff(self.indptr)
+
+    @property
+    def sources(self) -> NumpyTensor['n']:
+        """
+        Source face of each entry in indices.
+        """
+        if self._sources is None:
+            self._sources = np.repeat(np.arange(self.num_faces, dtype=np.int32), self.degrees)
+        return self._sources
+
+    @property
+    def edges(self) -> NumpyTensor['e 2']:
+        """
+        Unique undirected edges (f1, f2) with f1 < f2.
+        """
+        sources = self.sources
+        select = sources < self.indices
+        return np.stack([sources[select], self.indices[select]], axis=1)
+
+    def neighbors(self, face: int) -> NumpyTensor['k']:
+        """
+        """
+        return self.indices[self.indptr[face]:self.indptr[face + 1]]
+
+    def matrix(self) -> sparse.csr_matrix:
+        """
+        """
+        return sparse.csr_matrix(
+            (np.ones(len(self.indices), dtype=np.int8), self.indices, self.indptr), shape=(self.num_faces, self.num_faces)
+        )
+
+    def vote(self, labels: NumpyTensor['f'], valid: NumpyTensor['f']=None, faces: NumpyTensor['f']=None, fill=-1) -> tuple[
+        NumpyTensor['f'],
+        NumpyTensor['f']
+    ]:
+        """
+        Returns for each face the most frequent label among its valid neighbors and its count. Ties are broken in favor of
+        the label encountered first in neighbor order, i.e. Counter(labels of neighbors).most_common(1). Faces without
+        valid neighbors, or not selected by the faces mask, are assigned fill with count 0.
+        """
+        sources = self.sources
+        position = np.arange(len(self.indices))
+        select = np.ones(len(self.indices), dtype=bool)
+        if valid is not None:
+            select &= valid[self.indices]
+        if faces is not None:
+            select &= faces[sources]
+        sources, position = sources[select], position[select]
+        values = labels[self.indices[position]]
+
+        # count (face, label) groups, remembering where each group first occurs in neighbor order
+        order = np.lexsort((position, values, sources))
+        sources, values, position = sources[order], values[order], position[order]
+        start = np.ones(len(sources), dtype=bool)
+        start[1:] = (sources[1:] != sources[:-1]) | (values[1:] != values[:-1])
+        start = np.flatnonzero(start)
+        counts = np.diff(np.append(start, len(sources)))
+        sources, values, position = sources[start], values[start], position[start]
+
+        # select group with highest count, then earliest first occurrence
+        order = np.lexsort((position, -counts, sources))
+        sources, values, counts = sources[order], values[order], counts[order]
+        first = np.ones(len(sources), dtype=bool)
+        first[1:] = sources[1:] != sources[:-1]
+
+        labels_vote = np.full(self.num_faces, fill, dtype=labels.dtype)
+        counts_vote = np.zeros(self.num_faces, dtype=np.int64)
+        labels_vote[sources[first]] = values[first]
+        counts_vote[sources[first]] = counts[first]
+        return labels_vote, counts_vote
+
+    def components(self, labels: NumpyTensor['f'], valid: NumpyTensor['f']=None) -> tuple[NumpyTensor['f'], int]:
+        """
+        Returns connected components of valid faces sharing the same label, numbered by their smallest face, and the number
+        of components. Invalid faces are assigned -1.
+        """
+        sources = self.sources
+        select = labels[sources] == labels[self.indices]
+        if valid is not None:
+            select &= valid[sources] & valid[self.indices]
+        adjacency = sparse.csr_matrix(
+            (np.ones(select.sum(), dtype=np.int8), (sources[select], self.indices[select])), shape=(self.num_faces, self.num_faces)
+        )
+        _, components = csgraph.connected_components(adjacency, directed=False)
+        if valid is None:
+            return components, int(components.max()) + 1 if len(components) else 0
+
+        # renumber without invalid faces, preserving order
+        _, components_valid = np.unique(components[valid], return_inverse=True)
+        components = np.full(self.num_faces, -1, dtype=components.dtype)
+        components[valid] = components_valid
+        return components, int(components_valid.max()) + 1 if len(components_valid) else 0
+
+
+def label_components(
+    graph: FaceGraph, labels: NumpyTensor['f'], valid: NumpyTensor['f']=None, area_faces: NumpyTensor['f']=None
+) -> tuple[
+    NumpyTensor['f'],
+    NumpyTensor['c'],
+    NumpyTensor['c'] | None
+]:
+    """
+    Returns per face component ids (see FaceGraph.components) along with the number of faces and, if area_faces is given,
+    the total area of each component.
+    """
+    components, num_components = graph.components(labels, valid)
+    select = components != -1
+    sizes = np.bincount(components[select], minlength=num_components)
+    areas = None
+    if area_faces is not None:
+        areas = np.bincount(components[select], weights=area_faces[select], minlength=num_components)
+    return components, sizes, areas
@@ -0,0 +1,83 @@
+import tempfile
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import numpy as np
+import trimesh
+
+from samesh.utils.graph import FaceGraph, label_components
+
+
+def test_face_graph():
+    mesh = trimesh.creation.icosphere(subdivisions=2)
+    graph = FaceGraph.from_mesh(mesh)
+    adjacency = defaultdict(set)
+    for face1, face2 in mesh.face_adjacency:
+        adjacency[face1].add(face2)
+        adjacency[face2].add(face1)
+
+    assert graph.num_faces == len(mesh.faces)
+    for face in range(len(mesh.faces)):
+        assert graph.neighbors(face).tolist() == sorted(adjacency[face])
+    assert len(graph.edges) == len(mesh.face_adjacency)
+
+    with tempfile.TemporaryDirectory() as path:
+        graph.save(Path(path) / 'graph.npz')
+        graph_loaded = FaceGraph.load(Path(path) / 'graph.npz')
+    assert np.array_equal(graph.indptr , graph_loaded.indptr)
+    assert np.array_equal(graph.indices, graph_loaded.indices)
+
+
+def test_face_graph_vote():
+    mesh = trimesh.creation.icosphere(subdivisions=2)
+    graph = FaceGraph.from_mesh(mesh)
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 4, len(mesh.faces))
+    valid  = rng.random(len(mesh.faces)) < 0.7
+
+    labels_vote, counts_vote = graph.vote(labels, valid)
+    for face in range(len(mesh.faces)):
+        counter = Counter(labels[adj] for adj in graph.neighbors(face) if valid[adj])
+        if len(counter):
+            assert (labels_vote[face], counts_vote[face]) == counter.most_common(1)[0]
+        else:
+            assert (labels_vote[face], counts_vote[face]) == (-1, 0)
+
+    faces = rng.random(len(mesh.faces)) < 0.5
+    labels_vote_faces, counts_vote_faces = graph.vote(labels, valid, faces=faces)
+    assert np.array_equal(labels_vote_faces[faces], labels_vote[faces])
+    assert np.array_equal(counts_vote_faces[faces], counts_vote[faces])
+    assert (labels_vote_faces[~faces] == -1).all() and (counts_vote_faces[~faces] == 0).all()
+
+
+def test_face_graph_components():
+    # strip of 6 faces where consecutive faces are adjacent
+    graph = FaceGraph.from_edges(np.array([[0, 1], [1, 2], [2, 3], [3, 4], [4, 5]]), 6)
+    labels = np.array([1, 1, 2, 2, 1, 1])
+
+    components, num_components = graph.components(labels)
+    assert components.tolist() == [0, 0, 1, 1, 2, 2] and num_components == 3
+
+    components, num_components = graph.components(labels, valid=np.array([True, False, True, True, True, True]))
+    assert components.tolist() == [0, -1, 1, 1, 2, 2] and num_components == 3
+
+
+def test_label_components():
+    graph = FaceGraph.from_edges(np.array([[0, 1], [1, 2], [2, 3], [3, 4], [4, 5]]), 6)
+    labels = np.array([1, 1, 2, 2, 2, 1])
+
+    components, sizes, areas = label_components(graph, labels, area_faces=np.arange(6, dtype=float))
+    assert components.tolist() == [0, 0, 1, 1, 1, 2]
+    assert sizes.tolist() == [2, 3, 1] and areas.tolist() == [1, 9, 5]
+
+    components, sizes, areas = label_components(graph, labels, valid=labels != 1)
+    assert components.tolist() == [-1, -1, 0, 0, 0, -1]
+    assert sizes.tolist() == [3] and areas is None
+
+
+if __name__ == "__main__":
+    test_face_graph()
+    test_face_graph_vote()
+    test_face_graph_components()
+    test_label_components()
+    print("All tests passed!")
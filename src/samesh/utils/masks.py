@@ -0,0 +1,127 @@
+from functools import lru_cache
+from typing import Iterable
+
+import numpy as np
+
+from samesh.data.common import NumpyTensor
+
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8) # set bits of each byte
+
+
+class PackedMasks:
+    """
+    Stack of binary masks bit packed along width, 8x smaller than dense boolean masks. Indexing a single mask unpacks only
+    that mask, so the stack is never dense unless dense is called.
+    """
+    def __init__(self, data: NumpyTensor['n h w8'], width: int):
+        """
+        """
+        self.data = data
+        self.width = width
+
+    @classmethod
+    def pack(cls, masks: NumpyTensor['n h w'] | Iterable[NumpyTensor['h w']]) -> 'PackedMasks':
+        """
+        Packs a dense stack or masks one at a time, e.g. from a generator, without stacking them densely.
+        """
+        if isinstance(masks, np.ndarray):
+            return cls(np.packbits(masks.astype(bool), axis=-1), masks.shape[-1])
+        masks = [np.asarray(mask, dtype=bool) for mask in masks]
+        return cls(np.stack([np.packbits(mask, axis=-1) for mask in masks]), masks[0].shape[-1])
+
+    @classmethod
+    def concatenate(cls, masks: list['PackedMasks']) -> 'PackedMasks':
+        """
+        """
+        assert len({mask.width for mask in masks}) == 1, 'Masks must have the same width'
+        return cls(np.concatenate([mask.data for mask in masks], axis=0), masks[0].width)
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        return (len(self.data), self.data.shape[1], self.width)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index: int | slice) -> NumpyTensor['h w'] | 'PackedMasks':
+        """
+        Unpacks mask at index or returns masks in slice packed.
+        """
+        if isinstance(index, slice):
+            return PackedMasks(self.data[index], self.width)
+        return np.unpackbits(self.data[index], axis=-1, count=self.width).astype(bool)
+
+    def dense(self) -> NumpyTensor['n h w']:
+        """
+        """
+        return np.unpackbits(self.data, axis=-1, count=self.width).astype(bool)
+
+    def areas(self) -> NumpyTensor['n']:
+        """
+        Number of pixels in each mask, counted without unpacking.
+        """
+        return POPCOUNT[self.data].reshape(len(self.data), -1).sum(axis=1, dtype=np.int64)
+
+    def combine(self, order: NumpyTensor['n']=None, chunk_size=16) -> NumpyTensor['h w']:
+        """
+        Label image where the mask at position i of order, or index i if None, is labeled i + 1 and later masks overwrite
+        earlier ones. Masks are unpacked chunk_size at a time and each chunk is painted at once by its last mask per pixel.
+        """
+        order = np.arange(len(self)) if order is None else np.asarray(order)
+        combined = np.zeros(self.shape[1:], dtype=int)
+        for be in range(0, len(order), chunk_size):
+            chunk = np.unpackbits(self.data[order[be:be + chunk_size]], axis=-1, count=self.width).astype(bool)
+            last = len(chunk) - 1 - np.argmax(chunk[::-1], axis=0)
+            painted = chunk.any(axis=0)
+            combined[painted] = be + last[painted] + 1
+        return combined
+
+
+@lru_cache(maxsize=8)
+def pixel_priorities(shape: tuple[int, int], seed: int) -> NumpyTensor['h w']:
+    """
+    Distinct random priority of each pixel of an image of shape, cached since views share their shape.
+    """
+    priorities = np.random.default_rng(seed).permutation(shape[0] * shape[1]).astype(np.int64).reshape(shape)
+    priorities.flags.writeable = False
+    return priorities
+
+
+def point_grid_from_mask(mask: NumpyTensor['h w'], n: int, seed=0) -> NumpyTensor['n 2']:
+    """
+    Sample at most n points within valid mask normalized to [0, 1] x [0, 1]
+
+    The mask is stratified into the smallest square cells such that at most n of them contain valid pixels, and the valid
+    pixel of lowest priority in each of them is sampled, so points are spread evenly and thin parts are not skipped.
+    Priorities are random given seed, so the same mask always gives the same points.
+    """
+    indices = np.flatnonzero(mask)
+    if len(indices) == 0:
+        raise ValueError('No valid points in mask')
+
+    h, w = mask.shape
+    y, x = np.divmod(indices, w)
+    if n < len(indices):
+        size = np.sqrt(len(indices) / n) # cells of the valid area per point, grown until few enough are occupied
+        while True:
+            cells = (y / size).astype(np.int64) * (int(w / size) + 1) + (x / size).astype(np.int64)
+            if np.count_nonzero(np.bincount(cells)) <= n:
+                break
+            size *= 1.05
+        priorities = pixel_priorities((h, w), seed).ravel()[indices]
+        lowest = np.full(cells.max() + 1, h * w, dtype=np.int64)
+        np.minimum.at(lowest, cells, priorities)
+        chosen = priorities == lowest[cells] # priorities are distinct, so one pixel per cell
+        y, x = y[chosen], x[chosen]
+
+    samples = np.stack([x / (w - 1), y / (h - 1)], axis=1)
+    samples = samples[np.lexsort((samples[:, 1], samples[:, 0]))]
+    return samples
+
+
+def point_budget(mask: NumpyTensor['h w'], points_per_side: int, min_points=16) -> int:
+    """
+    Number of points to sample within mask at the density of a points_per_side grid over the whole image.
+    """
+    return max(min_points, int(np.ceil(points_per_side ** 2 * np.count_nonzero(mask) / mask.size)))
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from samesh.utils.masks import PackedMasks, point_budget, point_grid_from_mask
+
+
+def test_packed_masks():
+    rng = np.random.default_rng(0)
+    masks = rng.uniform(size=(5, 7, 13)) > 0.6 # width not a multiple of 8
+    packed = PackedMasks.pack(masks)
+    assert packed.shape == masks.shape
+    assert packed.data.nbytes < masks.nbytes
+    assert np.array_equal(packed.dense(), masks)
+    assert np.array_equal(packed[2], masks[2])
+    assert np.array_equal(packed[1:3].dense(), masks[1:3])
+    assert packed.areas().tolist() == masks.sum(axis=(1, 2)).tolist()
+    assert np.array_equal(PackedMasks.pack(iter(masks)).data, packed.data)
+    assert np.array_equal(PackedMasks.concatenate([packed[:2], packed[2:]]).dense(), masks)
+
+    combined = np.zeros(masks.shape[1:], dtype=int)
+    for i in [3, 0, 4]:
+        combined[masks[i]] = [3, 0, 4].index(i) + 1
+    assert np.array_equal(packed.combine([3, 0, 4]), combined)
+    assert np.array_equal(packed.combine([3, 0, 4], chunk_size=2), combined) # overwrites across chunks
+
+
+def test_point_grid_from_mask():
+    mask = np.zeros((64, 64), dtype=bool)
+    mask[8:40, 8:40] = True
+    mask[4:60, 50] = True # thin part
+    points = point_grid_from_mask(mask, 64)
+    assert np.array_equal(points, point_grid_from_mask(mask, 64))
+    assert len(points) <= 64
+    x, y = np.round(points[:, 0] * 63).astype(int), np.round(points[:, 1] * 63).astype(int)
+    assert mask[y, x].all()
+    assert np.count_nonzero(x == 50) >= 4
+    assert len(point_grid_from_mask(mask, mask.sum() + 1)) == mask.sum()
+
+    with pytest.raises(ValueError):
+        point_grid_from_mask(np.zeros((8, 8), dtype=bool), 4)
+
+
+def test_point_budget():
+    mask = np.zeros((64, 64), dtype=bool)
+    mask[:32] = True
+    assert point_budget(mask, 32) == 512 # half the grid
+    assert point_budget(mask, 4) == 16 # at least min_points
+    assert point_budget(mask, 4, min_points=1) == 8
+    mask[:] = False
+    mask[0, 0] = True
+    assert point_budget(mask, 32, min_points=0) == 1 # rounded up
+
+
+if __name__ == "__main__":
+    test_packed_masks()
+    test_point_grid_from_mask()
+    test_point_budget()
@@ -1,5 +1,8 @@
+import hashlib
+
 import numpy as np
 import trimesh
+from scipy.spatial import cKDTree
 from trimesh.base import Trimesh, Scene
 
 from samesh.data.common import NumpyTensor, TorchTensor
@@ -100,6 +103,39 @@ def norm_scene(scene: Scene) -> Scene:
     return scene
 
 
+def decimate_mesh(mesh: Trimesh, num_faces: int) -> Trimesh:
+    """
+    Quadric edge collapse decimation to about num_faces faces.
+
+    NOTE:: visuals are not preserved.
+    """
+    import pymeshlab # imported on use, since importing this module e.g. through samesh.data.loaders should not need it
+
+    meshset = pymeshlab.MeshSet()
+    meshset.add_mesh(pymeshlab.Mesh(mesh.vertices, mesh.faces))
+    meshset.meshing_decimation_quadric_edge_collapse(targetfacenum=num_faces, preservenormal=True, planarquadric=True)
+    decimated = meshset.current_mesh()
+    return Trimesh(vertices=decimated.vertex_matrix(), faces=decimated.face_matrix())
+
+
+def transfer_face_labels(source: Trimesh, labels: NumpyTensor['fs'], target: Trimesh) -> NumpyTensor['ft']:
+    """
+    Assigns each target face the label of the source face with nearest centroid.
+    """
+    _, index = cKDTree(source.triangles_center).query(target.triangles_center, workers=-1)
+    return labels[index]
+
+
+def hash_mesh(mesh: Trimesh) -> str:
+    """
+    Hash of mesh geometry i.e. vertex positions and faces in order, ignoring visuals.
+    """
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(mesh.vertices, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(mesh.faces, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
 if __name__ == "__main__":
     from samesh.data.loaders import read_mesh
     mesh = read_mesh('/home/ubuntu/meshseg/tests/examples/0ba4ae3aa97b4298866a2903de4fd1e7.glb')
@@ -0,0 +1,45 @@
+import numpy as np
+import trimesh
+
+from samesh.utils.mesh import decimate_mesh, hash_mesh, transfer_face_labels
+
+
+def test_hash_mesh():
+    mesh = trimesh.creation.icosphere(subdivisions=2)
+    assert hash_mesh(mesh) == hash_mesh(mesh.copy())
+    colored = mesh.copy()
+    colored.visual.face_colors = [255, 0, 0, 255]
+    assert hash_mesh(colored) == hash_mesh(mesh) # ignores visuals
+
+    moved = mesh.copy()
+    moved.vertices[0] += 1e-6
+    assert hash_mesh(moved) != hash_mesh(mesh)
+    flipped = trimesh.Trimesh(mesh.vertices, mesh.faces[:, ::-1], process=False)
+    assert hash_mesh(flipped) != hash_mesh(mesh)
+
+
+def test_transfer_face_labels():
+    mesh = trimesh.creation.icosphere(subdivisions=2)
+    labels = np.random.default_rng(0).integers(0, 5, len(mesh.faces))
+    assert np.array_equal(transfer_face_labels(mesh, labels, mesh), labels) # undecimated mesh round trips
+
+    permutation = np.random.default_rng(1).permutation(len(mesh.faces))
+    permuted = trimesh.Trimesh(mesh.vertices, mesh.faces[permutation], process=False)
+    assert np.array_equal(transfer_face_labels(mesh, labels, permuted), labels[permutation])
+
+
+def test_decimate_mesh():
+    mesh = trimesh.creation.icosphere(subdivisions=4)
+    decimated = decimate_mesh(mesh, 320)
+    assert len(decimated.faces) <= 320 < len(mesh.faces)
+    labels = (decimated.triangles_center[:, 2] > 0).astype(int)
+    transferred = transfer_face_labels(decimated, labels, mesh)
+    far = np.abs(mesh.triangles_center[:, 2]) > 0.2 # away from the boundary between labels
+    assert np.array_equal(transferred[far], (mesh.triangles_center[far, 2] > 0).astype(int))
+
+
+if __name__ == "__main__":
+    test_hash_mesh()
+    test_transfer_face_labels()
+    test_decimate_mesh()
+    print("All tests passed!")
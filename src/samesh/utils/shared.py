@@ -0,0 +1,100 @@
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from samesh.data.common import NumpyTensor
+
+
+SharedArrayDescriptors = dict[str, tuple[str, tuple, str]] # name -> (shared memory name, shape, dtype)
+
+
+class SharedArrays:
+    """
+    Publishes named arrays to shared memory once so pool workers can access them by descriptor instead of pickling:
+
+        with SharedArrays({'faces': faces}) as shared:
+            pool.starmap(func, [(shared.descriptors, i) for i in range(len(faces))])
+
+    where workers call attach_shared_arrays(descriptors) to obtain the arrays.
+    """
+    def __init__(self, arrays: dict[str, NumpyTensor | list[NumpyTensor]]):
+        """
+        Lists of equally shaped arrays are stacked directly into shared memory.
+        """
+        self.buffers = {}
+        self.descriptors = {}
+        try:
+            for name, array in arrays.items():
+                items = array if isinstance(array, (list, tuple)) else [array]
+                items = [np.asarray(item) for item in items]
+                shape = (len(items), *items[0].shape) if isinstance(array, (list, tuple)) else items[0].shape
+                dtype = items[0].dtype
+                buffer = SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+                self.buffers[name] = buffer # tracked before filling, so close unlinks it if anything below fails
+                shared = np.ndarray(shape, dtype=dtype, buffer=buffer.buf).reshape(-1, *items[0].shape)
+                for i, item in enumerate(items):
+                    shared[i] = item
+                del shared
+                self.descriptors[name] = (buffer.name, shape, dtype.str)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        """
+        for buffer in self.buffers.values():
+            buffer.close()
+            buffer.unlink()
+        self.buffers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_attached_buffers: dict[str, SharedMemory] = {}
+
+
+def attach_buffer(name: str) -> SharedMemory:
+    """
+    Attaches to existing shared memory without registering it with the resource tracker of the calling process, which
+    would otherwise unlink the buffer when a worker exits.
+    """
+    try:
+        return SharedMemory(name=name, track=False) # python >= 3.13
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def attach_shared_arrays(descriptors: SharedArrayDescriptors) -> dict[str, NumpyTensor]:
+    """
+    Returns read only views of arrays published by SharedArrays. Buffers are attached once per process and buffers of
+    previously published arrays are released.
+
+    NOTE:: returned views must not outlive the call that uses them, otherwise stale buffers cannot be released.
+    """
+    names = {buffer_name for buffer_name, _, _ in descriptors.values()}
+    for buffer_name in list(_attached_buffers):
+        if buffer_name not in names:
+            try:
+                _attached_buffers.pop(buffer_name).close()
+            except BufferError: # still referenced, released on process exit
+                pass
+
+    arrays = {}
+    for name, (buffer_name, shape, dtype) in descriptors.items():
+        if buffer_name not in _attached_buffers:
+            _attached_buffers[buffer_name] = attach_buffer(buffer_name)
+        array = np.ndarray(shape, dtype=dtype, buffer=_attached_buffers[buffer_name].buf)
+        array.flags.writeable = False
+        arrays[name] = array
+    return arrays
@@ -0,0 +1,50 @@
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pytest
+
+from samesh.utils import shared as shared_module
+from samesh.utils.shared import SharedArrays, attach_shared_arrays
+
+
+def sum_shared_array(descriptors: dict, name: str, index: int) -> float:
+    return float(attach_shared_arrays(descriptors)[name][index].sum())
+
+
+def test_shared_arrays():
+    faces = np.arange(24, dtype=np.int32).reshape(2, 3, 4)
+    norms = np.linspace(0, 1, 18).reshape(2, 3, 3)
+
+    with mp.Pool(2) as pool:
+        for offset in range(2): # publish twice to exercise release of stale buffers
+            with SharedArrays({'faces': faces + offset, 'norms': list(norms)}) as shared:
+                args = [(shared.descriptors, name, i) for name in ['faces', 'norms'] for i in range(2)]
+                sums = pool.starmap(sum_shared_array, args)
+            assert sums == [
+                float((faces[0] + offset).sum()),
+                float((faces[1] + offset).sum()),
+                float(norms[0].sum()),
+                float(norms[1].sum()),
+            ]
+
+
+def test_shared_arrays_failure(monkeypatch):
+    names = []
+    def create(**kwargs):
+        buffer = SharedMemory(**kwargs)
+        names.append(buffer.name)
+        return buffer
+    monkeypatch.setattr(shared_module, 'SharedMemory', create)
+
+    with pytest.raises(ValueError): # second item does not fit the shape of the first
+        SharedArrays({'faces': np.zeros(4), 'norms': [np.zeros(3), np.zeros(4)]})
+    assert len(names) == 2
+    for name in names: # segments created before the failure are unlinked
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=name)
+
+
+if __name__ == "__main__":
+    test_shared_arrays()
+    print("All tests passed!")